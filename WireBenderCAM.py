@@ -7,12 +7,16 @@ Build:
 Anderson Boyer
 """
 
+import multiprocessing
 import re
 from tkinter import *
 from tkinter import ttk, messagebox  # Import ttk for themed widgets
 from tkinter import filedialog
+from background_task import BackgroundTask
 from bender_gcode import BenderGCode
 from import_coords import ImportCoords
+from instrumentation import INSTRUMENTS
+from orientation_cost import DEFAULT_WEIGHTS
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 from point_object import PointObject
@@ -25,12 +29,15 @@ class GUI:
         self.gCodeString = []
         self.root = root
         self.filename = ""
+        # the bend calculation running in the background, see background_task.py
+        self.task = None
 
         Grid.rowconfigure(root, 0, weight=1)
         Grid.rowconfigure(root, 1, weight=1)
         Grid.rowconfigure(root, 2, weight=30)
         Grid.rowconfigure(root, 3, weight=1)
         Grid.rowconfigure(root, 4, weight=30)
+        Grid.rowconfigure(root, 5, weight=1)
         Grid.columnconfigure(root, 0, weight=1)
         Grid.columnconfigure(root, 1, weight=100)
         Grid.columnconfigure(root, 2, weight=1)
@@ -110,7 +117,19 @@ class GUI:
         self.canvas = FigureCanvasTkAgg(self.figure, master=root)  # A tk.DrawingArea.
         self.canvas.get_tk_widget().grid(row=1, column=3, sticky="nsew", rowspan=4, padx=0, pady=0)
 
-        self.coords = ImportCoords(self.figure, self.canvas)
+        # where the time of the last calculation went, see instrumentation.py
+        self.status_label = ttk.Label(root, text="")
+        self.status_label.grid(row=5, column=0, columnspan=3, padx=(15, 0), pady=(0, 5), sticky="nsew")
+
+        self.progress_bar = ttk.Progressbar(root, mode="determinate")
+        self.progress_bar.grid(row=5, column=3, padx=(10, 10), pady=(0, 5), sticky="ew")
+
+        # the four bend orientations are calculated in separate processes
+        self.coords = ImportCoords(self.figure, self.canvas, backend="process")
+
+        # stage times and counters are cheap, so they are always collected for the status bar
+        INSTRUMENTS.enable()
+        self.capture_profile = BooleanVar(value=False)
 
         # Create menu bar
         self.menubar = Menu(root)
@@ -121,6 +140,13 @@ class GUI:
         self.file_menu.add_command(label="Export G-Code", command=self.export_action, state="disabled")
         self.menubar.add_cascade(label="File", menu=self.file_menu)
 
+        # Create "Profile" menu
+        self.profile_menu = Menu(self.menubar, tearoff=0)
+        self.profile_menu.add_checkbutton(label="Capture Profile", variable=self.capture_profile)
+        self.profile_menu.add_command(label="Save Profile Report...", command=self.save_profile_report,
+                                      state="disabled")
+        self.menubar.add_cascade(label="Profile", menu=self.profile_menu)
+
         # Attach menu bar to the root window
         root.config(menu=self.menubar)
 
@@ -156,25 +182,37 @@ class GUI:
         # Check if a file path was chosen
         if file_path:
             # Save the G-code content to the chosen file
-            with open(file_path, 'w') as file:
-                for line1, line2 in zip(self.gCodeString[0], self.gCodeString[1]):
-                    combined_line = f"{line1.ljust(25)}{line2}"  # Adjust the width (20 in this example) based on your needs
-                    file.write(combined_line + '\n')
+            BenderGCode.write_lines(file_path, BenderGCode.format_lines(zip(*self.gCodeString)))
 
             # Inform the user that the file has been saved
             messagebox.showinfo("Save Complete", f"File saved at:\n{file_path}")
 
+    def save_profile_report(self):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            filetypes=[("JSON", "*.json"), ("All files", "*.*")],
+            initialfile=f"{self.filename.split('.')[0]}_profile"
+        )
+
+        if file_path:
+            # the trace goes next to the report, it opens in chrome://tracing or https://ui.perfetto.dev
+            trace_path = f"{file_path.rsplit('.', 1)[0]}_trace.json"
+            INSTRUMENTS.write_report(file_path, file=self.filename)
+            INSTRUMENTS.write_trace(trace_path)
+            messagebox.showinfo("Save Complete", f"Profile saved at:\n{file_path}\n{trace_path}")
+
     def calculate_bends_popup(self):
 
         # Create a Toplevel window (popup)
         calculate_bends_popup = Toplevel()
         calculate_bends_popup.title("Calculate Bends")
 
-        calculate_bends_popup.geometry("550x150")
+        calculate_bends_popup.geometry("550x190")
 
         Grid.rowconfigure(calculate_bends_popup, 0, weight=1)
         Grid.rowconfigure(calculate_bends_popup, 1, weight=1)
         Grid.rowconfigure(calculate_bends_popup, 2, weight=1)
+        Grid.rowconfigure(calculate_bends_popup, 3, weight=1)
         Grid.columnconfigure(calculate_bends_popup, 0, weight=1)
         Grid.columnconfigure(calculate_bends_popup, 1, weight=1)
 
@@ -195,13 +233,20 @@ class GUI:
         orientation_var = IntVar()
         orientation_var.set(1)
         orientation_checkbox = ttk.Checkbutton(
-            calculate_bends_popup, text="Show best orientation only (lowest collisions)", variable=orientation_var)
+            calculate_bends_popup, text="Show best orientation only (lowest collisions, then lowest cost)", variable=orientation_var)
         orientation_checkbox.grid(row=1, column=0, columnspan=2, padx=10, pady=10)
 
+        # Checkbutton for writing constant curvature runs as roll sections
+        roll_var = IntVar()
+        roll_var.set(int(self.coords.roll_sections))
+        roll_checkbox = ttk.Checkbutton(
+            calculate_bends_popup, text="Write smooth curves as roll sections", variable=roll_var)
+        roll_checkbox.grid(row=2, column=0, columnspan=2, padx=10, pady=(0, 10))
+
         # Next button
         next_button = ttk.Button(calculate_bends_popup, text="Next", command=lambda: self.calc_bends_next(
-            calculate_bends_popup, material_option.get(), orientation_var.get()))
-        next_button.grid(row=2, column=0, columnspan=2, pady=10)
+            calculate_bends_popup, material_option.get(), orientation_var.get(), roll_var.get()))
+        next_button.grid(row=3, column=0, columnspan=2, pady=10)
 
     @staticmethod
     def custom_material_popup():
@@ -250,7 +295,7 @@ class GUI:
     def warning_popup(message):
         messagebox.showwarning("Warning", message)
 
-    def calc_bends_next(self, calculate_bends_popup, material_string, orientation):
+    def calc_bends_next(self, calculate_bends_popup, material_string, orientation, roll_sections=0):
 
         if ((material_string == "Custom - 12mm Pin") or (material_string == "Custom - 16.5mm Pin") or
                 (material_string == "Custom - 27.5mm Pin")):
@@ -301,31 +346,87 @@ class GUI:
 
             pin_pos = string_to_pin_map.get(material_string)
 
-        self.coords.convert_coords(diameter, pin_pos)
-        self.button_calculate_bends.config(text="Next Plot", command=self.next)
-        self.coords.calculate_bends(material_file, diameter)
+        self.coords.roll_sections = roll_sections == 1
+
+        # the calculation runs on a copy in a worker thread so the window keeps responding, the plot and the tables
+        # are only updated once it is done
+        coords = self.coords.detached_copy()
+        capture_profile = self.capture_profile.get()
+
+        def calculate(progress):
+            coords.progress = progress
+            # the status bar and the profile report only cover this calculation, the profile is of the worker thread
+            INSTRUMENTS.disable()
+            INSTRUMENTS.reset()
+            INSTRUMENTS.enable(profile=capture_profile, trace=capture_profile)
+            try:
+                if orientation == 1:
+                    # the orientation with the fewest collisions, between equal counts the one with the lowest
+                    # combined cost (deleted vertices, duck cycles, rotation and cycle time), the same choice as
+                    # bender_scheduler.py
+                    coords.calculate_best_orientation(material_file, diameter, pin_pos, weights=DEFAULT_WEIGHTS,
+                                                      collisions_first=True)
+                else:
+                    coords.convert_coords(diameter, pin_pos)
+                    coords.calculate_bends(material_file, diameter)
+            finally:
+                # stops the profile, the stages and counters keep being collected
+                INSTRUMENTS.disable()
+                INSTRUMENTS.enable()
+            return coords
+
+        self.set_calculating(True)
+        self.task = BackgroundTask(self.root, calculate, on_progress=self.calculation_progress,
+                                   on_done=lambda result: self.calculation_done(result, orientation, pin_pos),
+                                   on_cancelled=self.calculation_cancelled,
+                                   on_error=self.calculation_failed).start()
+
+    def set_calculating(self, calculating):
+        # nothing that reads or replaces the orientations can be used while they are calculated
+        state = "disabled" if calculating else "normal"
+        self.file_menu.entryconfig(0, state=state)
+        self.file_menu.entryconfig(1, state="disabled" if calculating or not self.gCodeString else "normal")
+        self.profile_menu.entryconfig(1, state="disabled")
+        self.progress_bar.config(value=0)
+        if calculating:
+            self.button_calculate_bends.config(text="Cancel", command=self.cancel_calculation, state="normal")
+            self.status_label.config(text="Calculating...")
+
+    def cancel_calculation(self):
+        if self.task is not None and self.task.running:
+            self.task.cancel()
+            self.button_calculate_bends.config(text="Cancelling...", state="disabled")
+
+    def calculation_progress(self, text, done, total):
+        self.progress_bar.config(maximum=max(total, 1), value=done)
+        self.status_label.config(text=f"{text} {done} of {total}")
+
+    def calculation_cancelled(self):
+        self.task = None
+        self.set_calculating(False)
+        self.button_calculate_bends.config(text="Calculate Bends", command=self.calculate_bends_popup,
+                                           state="normal")
+        self.status_label.config(text="Calculation cancelled")
+
+    def calculation_failed(self, error):
+        self.calculation_cancelled()
+        self.status_label.config(text="Calculation failed")
+        self.warning_popup(f"The bends could not be calculated:\n\n{error}")
+
+    def calculation_done(self, coords, orientation, pin_pos):
+        self.task = None
+        self.coords.take_results(coords)
+        self.set_calculating(False)
+        # only the best orientation is calculated in that mode, there is nothing to go to
+        self.button_calculate_bends.config(text="Next Plot", command=self.next,
+                                           state="disabled" if orientation == 1 else "normal")
+        self.status_label.config(text=INSTRUMENTS.summary())
+        self.profile_menu.entryconfig(1, state="normal")
+
         self.collision_label.config(
             text=f'This orientation has {self.coords.point_objects[self.coords.plotIdx].collision_count} collisions'
-                 f' and {self.coords.point_objects[self.coords.plotIdx].deleted_vertices} deleted vertices')
-
-        if orientation == 1:
-            min_collisions = 111111111111111
-            min_idx = 4
-
-            for i in range(0, len(self.coords.point_objects)):
-                collision_count = self.coords.point_objects[self.coords.plotIdx].collision_count
-                if collision_count < min_collisions:
-                    min_collisions = collision_count
-                    min_idx = i
-
-            self.coords.plotIdx = min_idx
-
-            self.coords.update_gui()
-            self.collision_label.config(
-                text=f'This orientation has {self.coords.point_objects[self.coords.plotIdx].collision_count} collisions'
-                     f' and {self.coords.point_objects[self.coords.plotIdx].deleted_vertices} deleted vertices')
-
-            self.button_calculate_bends.config(state="disabled")
+                 f' and {self.coords.point_objects[self.coords.plotIdx].deleted_vertices} deleted vertices'
+                 f' ({self.coords.point_objects[self.coords.plotIdx].deviation:.2f} mm from the coordinates)')
 
         self.update_bend_table()
         self.update_code_box()
@@ -346,7 +447,8 @@ class GUI:
         self.coords.update_gui()
         self.collision_label.config(
             text=f'This orientation has {self.coords.point_objects[self.coords.plotIdx].collision_count} collisions'
-                 f' and {self.coords.point_objects[self.coords.plotIdx].deleted_vertices} deleted vertices')
+                 f' and {self.coords.point_objects[self.coords.plotIdx].deleted_vertices} deleted vertices'
+                 f' ({self.coords.point_objects[self.coords.plotIdx].deviation:.2f} mm from the coordinates)')
 
         self.update_bend_table()
 
@@ -373,6 +475,9 @@ class GUI:
 
 
 if __name__ == "__main__":
+    # needed for the orientation worker processes in the pyinstaller build
+    multiprocessing.freeze_support()
+
     window = Tk()
     window.title('Wire Bender SW')
     window.geometry("1500x900")
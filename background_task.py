@@ -0,0 +1,97 @@
+"""
+This module runs a long calculation next to the Tk main loop, so the window keeps responding while it runs.
+
+BackgroundTask calls func(progress) in a worker thread. The calculation reports how far it is by calling
+progress(text, done, total), e.g. progress("Calculating bends", 2, 4). Tk may only be used from its own thread, so
+nothing is handed to the GUI from the worker: the Tk thread polls the task with root.after and calls
+- on_progress(text, done, total) with the latest progress
+- on_done(result) once func returned
+- on_cancelled() once func stopped after cancel
+- on_error(error) if func raised
+
+cancel only sets a flag, the next progress call in the worker raises CalculationCancelled. The calculation should
+work on its own copy of the data (see ImportCoords.detached_copy), then a cancelled one can simply be dropped.
+
+Anderson Boyer
+"""
+
+import threading
+
+POLL_MS = 50  # how often the Tk thread looks at the task
+
+
+class CalculationCancelled(Exception):
+    """
+    Raised by the progress callback in the worker once the task was cancelled.
+    """
+
+
+class BackgroundTask:
+    """
+    Runs func(progress) in a daemon thread and reports back to the Tk thread of root, see the module docstring.
+    """
+    def __init__(self, root, func, on_progress=None, on_done=None, on_cancelled=None, on_error=None):
+        self.root = root
+        self.func = func
+        self.on_progress, self.on_done = on_progress, on_done
+        self.on_cancelled, self.on_error = on_cancelled, on_error
+        self._cancel = threading.Event()
+        self._progress = None  # latest (text, done, total), replaced as a whole so no lock is needed
+        self._reported = None
+        self._outcome = None  # ("done", result), ("cancelled", None) or ("error", exception)
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._outcome is None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.root.after(POLL_MS, self._poll)
+        return self
+
+    def cancel(self):
+        """
+        Asks the worker to stop at its next progress call.
+        """
+        self._cancel.set()
+
+    def progress(self, text, done, total):
+        """
+        The progress callback given to func, called from the worker thread.
+        """
+        if self._cancel.is_set():
+            raise CalculationCancelled()
+        self._progress = (text, done, total)
+
+    def _run(self):
+        try:
+            self._outcome = ("done", self.func(self.progress))
+        except CalculationCancelled:
+            self._outcome = ("cancelled", None)
+        except Exception as error:
+            self._outcome = ("error", error)
+
+    # runs in the Tk thread until the worker has finished
+    def _poll(self):
+        progress = self._progress
+        if progress is not None and progress != self._reported and self.on_progress is not None:
+            self._reported = progress
+            self.on_progress(*progress)
+
+        if self._outcome is None:
+            self.root.after(POLL_MS, self._poll)
+            return
+
+        kind, value = self._outcome
+        if kind == "done" and self.on_done is not None:
+            self.on_done(value)
+        elif kind == "cancelled" and self.on_cancelled is not None:
+            self.on_cancelled()
+        elif kind == "error" and self.on_error is not None:
+            self.on_error(value)
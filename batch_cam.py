@@ -0,0 +1,346 @@
+"""
+This module is the headless entry point to the CAM pipeline. It takes a directory of coordinate CSV files and writes
+one G-Code file per part without opening the GUI.
+
+Each part goes through the same steps as the GUI (load, convert_coords, calculate_bends, generate_gcode) and the
+parts are spread over a process pool. A part that fails is reported and skipped, the rest of the batch keeps going.
+
+Usage:
+    python batch_cam.py parts/ gcode/ --material "Mild Steel - 3mm.csv" --diameter 3 --pin-pos 16.5
+
+Anderson Boyer
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bender_gcode import BenderGCode
+from compensation_models import MODEL_KINDS
+from cycle_time import fastest_orientation, simulate
+from gcode_optimizer import optimize_gcode
+from instrumentation import INSTRUMENTS, call_instrumented
+from import_coords import ImportCoords
+from material_registry import MATERIALS
+from orientation_cost import DEFAULT_WEIGHTS, score_program
+from result_cache import DEFAULT_MAX_BYTES, ResultCache, cache_orientations, restore_orientations
+
+MATERIALS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Materials")
+
+
+# returns an absolute path to a material file, falling back to the Materials folder next to this script
+def resolve_material(material_file):
+    if os.path.isfile(material_file):
+        return os.path.abspath(material_file)
+    return os.path.join(MATERIALS_DIR, material_file)
+
+
+def write_gcode_file(file_path, gcode_string, comments=True):
+    BenderGCode.write_lines(file_path, BenderGCode.format_lines(zip(*gcode_string), comments=comments))
+
+
+def process_part(csv_path, output_dir, material_file, diameter, pin_pos, all_orientations=False,
+                 swept_collisions=False, part_files=False, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                 compensation="poly", comments=True, optimize=False, fastest=False, weights=None, max_deviation=None,
+                 roll_sections=False, roll_clearance=None):
+    """
+    Runs one CSV file through the whole pipeline and writes its G-Code.
+
+    With part_files a <part>.npz file (see part_file.py) is kept next to the G-Code and the calculation is
+    skipped if that file already holds the results for the same coordinates, material and settings.
+    With cache_dir the final results of every orientation are looked up in (and added to) a ResultCache shared by
+    all workers, a hit skips the calculation and the G-Code generation. Without comments only the G-Code column is
+    written. With optimize the programs go through gcode_optimizer.optimize_gcode before they are written. With
+    fastest the orientation with the shortest simulated cycle time (cycle_time.py) is picked out of the ones with
+    the fewest collisions (cycle_time.fastest_orientation). With weights the orientation with the lowest combined
+    cost (see orientation_cost.py) out of the ones with the fewest collisions is picked instead, weights only needs
+    the terms that differ from orientation_cost.DEFAULT_WEIGHTS. max_deviation
+    (mm) removes vertices that are not needed to stay that close to the coordinates, see polyline_simplify.py.
+    With roll_sections constant curvature runs are written as loops, roll_clearance shortens the pin return in
+    them (see roll_sections.py).
+
+    Returns a dict with the part name, the files written, the chosen orientation and its collision count,
+    the wall time in seconds and the error message if the part failed. Never raises.
+    """
+    start = time.perf_counter()
+    part = os.path.splitext(os.path.basename(csv_path))[0]
+    result = {"part": part, "ok": False, "outputs": [], "orientation": None, "collisions": None,
+              "deleted_vertices": None, "seconds": 0.0, "error": None, "reused": False,
+              "cached": False, "seconds_saved": 0.0,
+              "cycle_seconds": None, "cost": None, "deviation": None}
+
+    try:
+        coords = ImportCoords(swept_collisions=swept_collisions, compensation=compensation, max_deviation=max_deviation,
+                              roll_sections=roll_sections, roll_clearance=roll_clearance)
+        coords.load_file(csv_path)
+        if len(coords.point_objects) == 0:
+            raise ValueError("no coordinates could be read from the file")
+
+        cache = ResultCache(cache_dir, cache_max_bytes) if cache_dir else None
+        if cache:
+            cache_key = coords.part_key(diameter, pin_pos, material_file)
+            entry = cache.get(cache_key)
+            result["cached"] = entry is not None
+
+        if result["cached"]:
+            orientations = entry["orientations"]
+            restore_orientations(coords.point_objects, orientations)
+            counts = [orientation["collision_count"] for orientation in orientations]
+            deleted = [orientation["deleted_vertices"] for orientation in orientations]
+            deviations = [orientation["deviation"] for orientation in orientations]
+            gcode_strings = [orientation["gcode"] for orientation in orientations]
+        else:
+            part_path = os.path.join(output_dir, f"{part}.npz")
+            if part_files and os.path.isfile(part_path):
+                result["reused"] = coords.load_part_file(part_path, diameter, pin_pos, material_file)
+
+            if not result["reused"]:
+                coords.convert_coords(diameter, pin_pos)
+                coords.calculate_bends(material_file, diameter)
+                if part_files:
+                    coords.save_part_file(part_path, diameter, pin_pos, material_file)
+
+            counts = [points.collision_count for points in coords.point_objects]
+            deleted = [points.deleted_vertices for points in coords.point_objects]
+            deviations = [points.deviation for points in coords.point_objects]
+            # the cache needs every orientation as lists, otherwise the G-Code is streamed straight to the file
+            gcode_strings = [None] * len(coords.point_objects)
+            if cache:
+                gcode_strings = [BenderGCode(points).generate_gcode() for points in coords.point_objects]
+                cache.put(cache_key, cache_orientations(coords.point_objects, gcode_strings))
+
+        if fastest or weights is not None:
+            for idx in range(len(gcode_strings)):
+                if gcode_strings[idx] is None:
+                    gcode_strings[idx] = BenderGCode(coords.point_objects[idx]).generate_gcode()
+        if weights is not None:
+            scores = [score_program(counts[idx], deleted[idx], gcode_strings[idx], weights, index=idx)
+                      for idx in range(len(gcode_strings))]
+            # a colliding orientation never wins on cost, the same ranking as the GUI and the scheduler
+            best = min(scores, key=lambda score: (score.collisions, score.cost, score.index))
+            best_idx = best.index
+            result["cost"], result["cycle_seconds"] = best.cost, best.cycle_seconds
+        else:
+            if fastest:
+                best_idx = fastest_orientation(coords.point_objects, gcode_strings=gcode_strings)
+                result["cycle_seconds"] = simulate(gcode_strings[best_idx]).seconds
+            else:
+                # fewest collisions, the first one wins a tie
+                best_idx = min(range(len(counts)), key=counts.__getitem__)
+        indices = range(len(counts)) if all_orientations else [best_idx]
+
+        for idx in indices:
+            suffix = f"_orientation{idx + 1}" if all_orientations else ""
+            file_path = os.path.join(output_dir, f"{part}{suffix}.gcode")
+            gcode_string = gcode_strings[idx]
+            if optimize:
+                if gcode_string is None:
+                    gcode_string = BenderGCode(coords.point_objects[idx]).generate_gcode()
+                gcode_string, report = optimize_gcode(gcode_string)
+                if idx == best_idx:
+                    result["seconds_saved"] = report.seconds_saved
+
+            if gcode_string is None:
+                BenderGCode(coords.point_objects[idx]).stream_gcode(file_path, comments)
+            else:
+                write_gcode_file(file_path, gcode_string, comments)
+            result["outputs"].append(file_path)
+
+        result["orientation"] = best_idx + 1
+        result["collisions"] = counts[best_idx]
+        result["deleted_vertices"] = deleted[best_idx]
+        result["deviation"] = deviations[best_idx]
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(input_dir, output_dir, material_file, diameter, pin_pos, workers=None, all_orientations=False,
+              swept_collisions=False, part_files=False, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+              compensation="poly", comments=True, optimize=False, fastest=False, weights=None, max_deviation=None,
+              roll_sections=False, roll_clearance=None, instrument=False, profile=False, trace=False, log=print):
+    """
+    Processes every .csv file in input_dir and writes the G-Code files to output_dir.
+
+    Parameters:
+    - workers: number of worker processes, None uses every core and 1 runs in this process
+    - cache_dir: directory of a ResultCache shared by all workers, None disables the cache
+    - cache_max_bytes: size bound of the cache directory, least recently used results are removed past it
+    - compensation: compensation model kind, see compensation_models.MODEL_KINDS
+    - comments: False writes the G-Code without the comment column
+    - optimize: merge moves and drop redundant pin moves, see gcode_optimizer.py
+    - fastest: pick the orientation with the shortest cycle time out of the ones with the fewest collisions
+    - weights: pick the orientation with the lowest combined cost out of the ones with the fewest collisions instead,
+      see orientation_cost.py
+    - max_deviation: remove vertices that are not needed to stay within this many mm of the coordinates
+    - roll_sections: write constant curvature runs as loops, roll_clearance (degrees) shortens the pin return in them
+    - instrument: collect stage times and counters from every part (see instrumentation.py), the summary gets them
+      as "instrumentation". profile also captures a cProfile and trace keeps a trace of every stage. The profile
+      only sees this process, so use it with workers=1.
+    - log: called with one line of text per finished part and for the summary, None for silent
+
+    Returns the list of per-part results (see process_part) and a summary dict.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    material_file = resolve_material(material_file)
+    csv_files = sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                       if name.lower().endswith(".csv"))
+    log = log or (lambda line: None)
+
+    # fitting the model here also reports a bad material file once instead of once per part
+    for line in MATERIALS.model(material_file, compensation).report():
+        log(f"compensation {line}")
+
+    start = time.perf_counter()
+    results = []
+    args = (output_dir, material_file, diameter, pin_pos, all_orientations, swept_collisions, part_files, cache_dir,
+            cache_max_bytes, compensation, comments, optimize, fastest, weights, max_deviation, roll_sections,
+            roll_clearance)
+
+    instrument = instrument or profile or trace
+    if instrument:
+        INSTRUMENTS.reset()
+        INSTRUMENTS.enable(profile=profile, trace=trace)
+
+    def report(result):
+        if instrument and workers != 1:
+            result, snapshot = result
+            INSTRUMENTS.merge(snapshot)
+        results.append(result)
+        if result["ok"]:
+            log(f'{result["part"]}: {result["seconds"]:.3f} s, orientation {result["orientation"]}, '
+                f'{result["collisions"]} collisions, {result["deleted_vertices"]} deleted vertices, '
+                f'{result["deviation"]:.2f} mm deviation'
+                f'{", {:.1f} s cycle".format(result["cycle_seconds"]) if result["cycle_seconds"] else ""}'
+                f'{", cost {:.1f}".format(result["cost"]) if result["cost"] is not None else ""}'
+                f'{" (cached)" if result["cached"] else " (reused part file)" if result["reused"] else ""}')
+        else:
+            log(f'{result["part"]}: FAILED after {result["seconds"]:.3f} s ({result["error"]})')
+
+    if workers == 1:
+        for csv_path in csv_files:
+            report(process_part(csv_path, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if instrument:
+                futures = [pool.submit(call_instrumented, process_part, trace, csv_path, *args)
+                           for csv_path in csv_files]
+            else:
+                futures = [pool.submit(process_part, csv_path, *args) for csv_path in csv_files]
+            for future in as_completed(futures):
+                report(future.result())
+
+    wall_time = time.perf_counter() - start
+    if instrument:
+        INSTRUMENTS.disable()
+    succeeded = sum(1 for result in results if result["ok"])
+    summary = {
+        "parts": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "wall_seconds": wall_time,
+        "cpu_seconds": sum(result["seconds"] for result in results),
+        "parts_per_second": len(results) / wall_time if wall_time > 0 else 0.0,
+    }
+    if optimize:
+        summary["seconds_saved"] = sum(result["seconds_saved"] for result in results)
+    if instrument:
+        summary["instrumentation"] = INSTRUMENTS.report()
+        log(INSTRUMENTS.summary())
+    if cache_dir:
+        summary["cache_hits"] = sum(1 for result in results if result["cached"])
+        summary["cache_misses"] = len(results) - summary["cache_hits"]
+    log(f'{summary["parts"]} parts ({summary["failed"]} failed) in {wall_time:.2f} s, '
+        f'{summary["parts_per_second"]:.2f} parts/s'
+        f'{", {} cache hits".format(summary["cache_hits"]) if cache_dir else ""}'
+        f'{", about {:.1f} s of machine time saved".format(summary["seconds_saved"]) if optimize else ""}')
+
+    results.sort(key=lambda result: result["part"])
+    return results, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory of coordinate CSV files to G-Code")
+    parser.add_argument("input_dir", help="directory containing the part CSV files")
+    parser.add_argument("output_dir", help="directory the .gcode files are written to")
+    parser.add_argument("--material", required=True, help="material CSV, either a path or a file in Materials/")
+    parser.add_argument("--diameter", type=float, required=True, help="wire diameter in mm")
+    parser.add_argument("--pin-pos", type=float, required=True, help="bend pin position in mm (12, 16.5 or 27.5)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--all-orientations", action="store_true",
+                        help="write all four bend orientations instead of only the one with the fewest collisions")
+    parser.add_argument("--swept-collisions", action="store_true",
+                        help="check the wire segments as capsules instead of only the vertices")
+    parser.add_argument("--part-files", action="store_true",
+                        help="keep a .npz part file with the results next to each G-Code file and reuse it")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of a result cache shared between runs, repeated parts are not recalculated")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_BYTES / 2 ** 20,
+                        help="maximum size of the result cache in MB (default: %(default)d)")
+    parser.add_argument("--compensation", choices=MODEL_KINDS, default="poly",
+                        help="compensation model fitted to the material file (default: %(default)s)")
+    parser.add_argument("--no-comments", action="store_true", help="leave the comments out of the G-Code files")
+    parser.add_argument("--fastest", action="store_true",
+                        help="pick the orientation with the shortest cycle time out of the ones with fewest collisions")
+    parser.add_argument("--optimize", action="store_true",
+                        help="merge feed moves and drop redundant pin moves from the G-Code")
+    parser.add_argument("--cost", action="store_true",
+                        help="pick the orientation with the fewest collisions and of those the lowest combined cost "
+                             "of collisions, deleted vertices, duck cycles, rotation and cycle time")
+    parser.add_argument("--weight", action="append", default=[], metavar="NAME=VALUE",
+                        help=f"change a cost weight, implies --cost, names: {', '.join(DEFAULT_WEIGHTS)}")
+    parser.add_argument("--max-deviation", type=float, default=None,
+                        help="first remove vertices that are not needed to stay within this many mm of the coordinates")
+    parser.add_argument("--roll-sections", action="store_true",
+                        help="write runs of equal bends (smooth curves) as loops instead of bend by bend")
+    parser.add_argument("--roll-clearance", type=float, default=None,
+                        help="degrees the pin backs off between the bends of a roll section, implies --roll-sections "
+                             "(default: full return)")
+    parser.add_argument("--report", default=None, metavar="JSON",
+                        help="write the results, stage times and counters of the run to this JSON file")
+    parser.add_argument("--profile", action="store_true",
+                        help="add a cProfile of the run to the report, the parts are run in this process")
+    parser.add_argument("--trace", default=None, metavar="JSON",
+                        help="write a trace of every stage (chrome://tracing format) to this file")
+    args = parser.parse_args(argv)
+    if args.profile and not args.report:
+        parser.error("--profile needs --report, the profile is written to the report")
+
+    weights = None
+    if args.cost or args.weight:
+        weights = {}
+        for text in args.weight:
+            name, _, value = text.partition("=")
+            if name not in DEFAULT_WEIGHTS:
+                parser.error(f"unknown cost weight {name!r}")
+            try:
+                weights[name] = float(value)
+            except ValueError:
+                parser.error(f"bad cost weight {text!r}")
+
+    results, summary = run_batch(args.input_dir, args.output_dir, args.material, args.diameter, args.pin_pos,
+                                 workers=1 if args.profile else args.workers, all_orientations=args.all_orientations,
+                                 swept_collisions=args.swept_collisions, part_files=args.part_files,
+                                 cache_dir=args.cache_dir, cache_max_bytes=int(args.cache_size * 2 ** 20),
+                                 compensation=args.compensation, comments=not args.no_comments,
+                                 optimize=args.optimize, fastest=args.fastest, weights=weights,
+                                 max_deviation=args.max_deviation,
+                                 roll_sections=args.roll_sections or args.roll_clearance is not None,
+                                 roll_clearance=args.roll_clearance,
+                                 instrument=args.report is not None, profile=args.profile,
+                                 trace=args.trace is not None)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump({"summary": summary, "parts": results}, file, indent=1)
+    if args.trace:
+        INSTRUMENTS.write_trace(args.trace)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
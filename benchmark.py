@@ -0,0 +1,256 @@
+"""
+This module times the CAM pipeline stage by stage on synthetic parts, without the GUI (Tk is never imported).
+
+Parts are generated in a few shapes and sizes:
+- zigzag: a flat zigzag with 20 mm legs, every vertex is a real bend so nothing is filtered out
+- helix: a 30 mm radius coil with 4 mm between the points, the minimum extrusion filtering removes most of them
+- spline: a smooth random 3D curve of fixed length sampled with more and more points, like a dense CAD export
+
+Every part is written to a CSV file and run through the stages the way the GUI runs them, each one timed on its own:
+load (CSV to the four orientations), filter (minimum extrusion filtering in convert_coords), transform (rotation into
+the bender coordinate system), find_bends (without the collision checks), collision_detection, apply_compensation
+and generate_gcode. Each part is repeated and the fastest run of each stage is kept.
+
+The results are written to a JSON file together with the scaling exponent of every stage (the slope of log(seconds)
+over log(vertices)), so a stage that got slower or went from linear to quadratic stands out. --compare reads an
+earlier results file and reports the stages that got slower.
+
+A size is skipped once the one before it suggests it would take longer than --budget seconds (the collision checks
+are quadratic in the number of bends).
+
+    python benchmark.py --sizes 10 100 1000 10000 100000 --output benchmark.json
+
+Anderson Boyer
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+
+from batch_cam import resolve_material
+from bender_gcode import BenderGCode
+from import_coords import ImportCoords
+from result_cache import CODE_VERSION
+
+RESULTS_VERSION = 1
+SHAPES = ("zigzag", "helix", "spline")
+STAGES = ("load", "filter", "transform", "find_bends", "collision_detection", "apply_compensation",
+          "generate_gcode")
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+REGRESSION_RATIO = 1.25  # a stage this much slower than in the compared results is reported
+
+
+# flat zigzag with legs of 20 mm at 90 degrees
+def zigzag(count):
+    i = np.arange(count)
+    return np.column_stack((i * 14.142, (i % 2) * 14.142, np.zeros(count)))
+
+
+# coil of radius 30 mm, 4 mm between the points and 10 mm pitch
+def helix(count):
+    t = np.arange(count) * 4 / 30
+    return np.column_stack((30 * np.cos(t), 30 * np.sin(t), t * 10 / (2 * math.pi)))
+
+
+# smooth random curve of about 500 mm, the same curve for every count
+def spline(count, seed=0):
+    rng = np.random.default_rng(seed)
+    frequencies = rng.uniform(.5, 3, (3, 4))
+    phases = rng.uniform(0, 2 * math.pi, (3, 4))
+    t = np.linspace(0, 1, max(count, 2))[:count]
+    waves = np.sin(2 * math.pi * frequencies[..., None] * t + phases[..., None]).sum(axis=1).T
+    return np.column_stack((t * 300, np.zeros(count), np.zeros(count))) + waves * 20
+
+
+GENERATORS = {"zigzag": zigzag, "helix": helix, "spline": spline}
+
+
+def write_part(path, coords):
+    np.savetxt(path, coords, delimiter=',', fmt='%.6f')
+
+
+class StageTimer:
+    """
+    Adds up the time spent in each stage, use as timer.stage(name) in a with statement.
+    wrap replaces a method of an object with one that is timed as the given stage.
+    """
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in STAGES}
+
+    def stage(self, name):
+        return _TimedBlock(self.seconds, name)
+
+    def wrap(self, obj, method_name, name):
+        method = getattr(obj, method_name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.seconds[name] += time.perf_counter() - start
+        setattr(obj, method_name, timed)
+
+
+class _TimedBlock:
+    def __init__(self, seconds, name):
+        self.seconds, self.name = seconds, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.seconds[self.name] += time.perf_counter() - self.start
+
+
+# runs one part through the pipeline and returns the seconds of each stage and the vertices left after filtering
+def run_part(csv_path, material_file, diameter, pin_pos):
+    timer = StageTimer()
+    coords = ImportCoords()
+    with timer.stage("load"):
+        coords.load_file(csv_path)
+
+    for idx, points in enumerate(coords.point_objects):
+        with timer.stage("filter"):
+            ImportCoords.filter_orientation(points, diameter, pin_pos, idx >= 2)
+        with timer.stage("transform"):
+            ImportCoords.transform_orientation(points, pin_pos, idx % 2 == 1)
+
+    # find_bends calls collision_detection for every check, that time is counted separately
+    for points in coords.point_objects:
+        timer.wrap(points, "collision_detection", "collision_detection")
+        with timer.stage("find_bends"):
+            points.find_bends(diameter)
+    timer.seconds["find_bends"] -= timer.seconds["collision_detection"]
+
+    coords.compute_compensation_coefficients(material_file)
+    for points in coords.point_objects:
+        with timer.stage("apply_compensation"):
+            points.apply_compensation(coords.compensation_coeff)
+        with timer.stage("generate_gcode"):
+            BenderGCode(points).generate_gcode()
+
+    return timer.seconds, len(coords.point_objects[0])
+
+
+def scaling_exponents(results):
+    """
+    Returns {shape: {stage: exponent}}, the least squares slope of log(seconds) over log(vertices) for every stage
+    that was measured at two or more sizes.
+    """
+    exponents = {}
+    for shape in sorted({result["shape"] for result in results}):
+        rows = [result for result in results if result["shape"] == shape and not result["skipped"]]
+        exponents[shape] = {}
+        for stage in STAGES:
+            sizes = np.array([row["vertices"] for row in rows], dtype=np.float64)
+            seconds = np.array([row["stages"][stage] for row in rows])
+            measured = seconds > 0
+            if measured.sum() >= 2:
+                exponents[shape][stage] = float(np.polyfit(np.log(sizes[measured]), np.log(seconds[measured]), 1)[0])
+    return exponents
+
+
+def run_benchmark(shapes=SHAPES, sizes=DEFAULT_SIZES, repeat=3, budget=60.0, material_file="Mild Steel - 3mm.csv",
+                  diameter=3.0, pin_pos=16.5, log=print):
+    """
+    Times every shape at every size and returns the results dict that main writes as JSON.
+    """
+    material_file = resolve_material(material_file)
+    log = log or (lambda line: None)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for shape in shapes:
+            previous = None  # (vertices, seconds of one run) of the last size that was run
+            for size in sorted(sizes):
+                # the collision checks are quadratic, so that is what the next size is estimated with
+                if previous is not None and previous[1] * (size / previous[0]) ** 2 > budget:
+                    results.append({"shape": shape, "vertices": size, "skipped": True})
+                    log(f"{shape:>7} {size:>7}: skipped, over the {budget:g} s budget")
+                    continue
+
+                csv_path = os.path.join(directory, f"{shape}_{size}.csv")
+                write_part(csv_path, GENERATORS[shape](size))
+                best = None
+                for _ in range(repeat):
+                    seconds, kept = run_part(csv_path, material_file, diameter, pin_pos)
+                    best = seconds if best is None else {stage: min(best[stage], seconds[stage]) for stage in STAGES}
+                total = sum(best.values())
+                previous = (size, total)
+                results.append({"shape": shape, "vertices": size, "kept_vertices": kept, "skipped": False,
+                                "stages": best, "total": total})
+                log(f"{shape:>7} {size:>7}: {total:8.3f} s, {kept} vertices after filtering, slowest stage "
+                    f"{max(best, key=best.get)}")
+
+    return {
+        "version": RESULTS_VERSION,
+        "code_version": CODE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "settings": {"repeat": repeat, "material": os.path.basename(material_file), "diameter": diameter,
+                     "pin_pos": pin_pos},
+        "results": results,
+        "scaling": scaling_exponents(results),
+    }
+
+
+def compare_results(old, new, ratio=REGRESSION_RATIO):
+    """
+    Returns (shape, vertices, stage, old seconds, new seconds) for every stage that is more than ratio times slower
+    in new than in old. Stages under a millisecond are left out, they are mostly timer noise.
+    """
+    old_rows = {(row["shape"], row["vertices"]): row for row in old["results"] if not row["skipped"]}
+    slower = []
+    for row in new["results"]:
+        old_row = old_rows.get((row["shape"], row["vertices"]))
+        if row["skipped"] or old_row is None:
+            continue
+        for stage in STAGES:
+            before, after = old_row["stages"][stage], row["stages"][stage]
+            if after > 1e-3 and after > before * ratio:
+                slower.append((row["shape"], row["vertices"], stage, before, after))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the CAM pipeline stages on synthetic parts")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES), help="part shapes to run")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help="vertex counts of the parts (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per part, the fastest is kept")
+    parser.add_argument("--budget", type=float, default=60.0,
+                        help="skip sizes estimated to take longer than this many seconds per run")
+    parser.add_argument("--material", default="Mild Steel - 3mm.csv",
+                        help="material CSV, either a path or a file in Materials/")
+    parser.add_argument("--diameter", type=float, default=3.0, help="wire diameter in mm")
+    parser.add_argument("--pin-pos", type=float, default=16.5, help="bend pin position in mm")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", default=None, help="earlier results file to check for slower stages")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.shapes, args.sizes, args.repeat, args.budget, args.material, args.diameter,
+                           args.pin_pos)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    for shape, exponents in report["scaling"].items():
+        print(f"{shape} scaling: " + ", ".join(f"{stage} {value:.2f}" for stage, value in exponents.items()))
+
+    if args.compare:
+        with open(args.compare) as file:
+            slower = compare_results(json.load(file), report)
+        for shape, size, stage, before, after in slower:
+            print(f"SLOWER {shape} {size} {stage}: {before:.4f} s -> {after:.4f} s")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,6 +4,16 @@ The constructor takes a point_object and copies all important instance variables
 
 Anderson Boyer
 """
+import io
+import os
+import socket
+
+from instrumentation import INSTRUMENTS
+from roll_sections import MIN_ROLL_BENDS, loop_value
+
+WRITE_BUFFER_SIZE = 1 << 16
+
+
 class BenderGCode:
 
     def __init__(self, point_object):
@@ -13,7 +23,9 @@ class BenderGCode:
         self.A = point_object.A
         self.MA = point_object.MA
         self.pin_pos = point_object.pin_pos
+        self.roll_sections = point_object.roll_sections
 
+    @INSTRUMENTS.timed("generate_gcode")
     def generate_gcode(self):
         """
         Generate G-code based on LRA data and save it to a file.
@@ -24,23 +36,41 @@ class BenderGCode:
 
         gcode = []
         comment = []
+        for line, line_comment in self.iter_gcode():
+            gcode.append(line)
+            comment.append(line_comment)
+        INSTRUMENTS.count("gcode_lines", len(gcode))
+        return [gcode, comment]
 
-        gcode.append("%")
-        comment.append("")
-
-        gcode.append(f'; For use with {round(self.pin_pos, 1)} mm pin only')
-        comment.append("")
-        gcode.append("")
-        comment.append("")
-        gcode.append("")
-        comment.append("")
-
-        gcode.append("G28")
-        comment.append(";   Home all axes")
+    def iter_gcode(self):
+        """
+        Yields the same (gcode, comment) lines as generate_gcode one at a time. A line is held back until the next
+        one starts because a wire rotation is added to the end of the line before it.
+        """
+        pending = None
+        for line, line_comment, append in self._gcode_steps():
+            if append:
+                pending = (pending[0] + line, pending[1] + line_comment)
+                continue
+            if pending is not None:
+                yield pending
+            pending = (line, line_comment)
+        if pending is not None:
+            yield pending
+
+    # yields (gcode, comment, append) for each step of the program, append adds the text to the previous line
+    # instead of starting a new one
+    def _gcode_steps(self):
+        yield "%", "", False
+
+        yield f'; For use with {round(self.pin_pos, 1)} mm pin only', "", False
+        yield "", "", False
+        yield "", "", False
+
+        yield "G28", ";   Home all axes", False
 
         if self.pin_pos > 12.1:
-            gcode.append("M98 P\"not12mm.g\"")
-            comment.append("")
+            yield "M98 P\"not12mm.g\"", "", False
 
         bender_position = 1
 
@@ -48,70 +78,148 @@ class BenderGCode:
         current_x = 0.0
         current_y = 0.0
 
+        sections = {section.start: section for section in self.roll_sections}
+
         # Iterate through LRA data and add G1 commands based on thresholds
-        for i in range(len(self.L)):
+        i = 0
+        while i < len(self.L):
+            section = sections.get(i)
+            if (section is not None) & (len(self.R) > 0) & (len(self.A) > 0):
+                if bender_position == (-1 if section.angle > 0 else 1):
+                    yield from self._roll_section_steps(section, current_x, current_y)
+                    current_x += sum(self.L[i:i + section.count])
+                    # always, a rotation too small to command is still made up by the next Y
+                    current_y += sum(self.R[i:i + section.count])
+                    i += section.count
+                    continue
+                if section.count > MIN_ROLL_BENDS:
+                    # the first bend has to duck the pin, the rest of the section can still be a loop
+                    sections[i + 1] = section._replace(start=i + 1, count=section.count - 1)
+
             # Check L value threshold
             if abs(self.L[i]) > 0.01:  # Adjust the threshold as needed
                 # Update current_x
                 current_x += self.L[i]
                 # Add G1 command for X movement
-                gcode.append(f"G0 X{round(current_x, 2)}")
-                comment.append(f';  Extrude wire {round(self.L[i], 2)} mm')
+                yield f"G0 X{round(current_x, 2)}", f';  Extrude wire {round(self.L[i], 2)} mm', False
 
             if (len(self.R) > 0) & (len(self.A) > 0):
                 # Check R value threshold
                 if abs(self.R[i]) > 0.01:  # Adjust the threshold as needed
                     # Add G1 command for Y movement on same line
                     current_y += self.R[i]
-                    gcode[-1] = gcode[-1] + f" Y{round(current_y, 2)}"
-                    comment[-1] = comment[-1] + f' and rotate wire {round(self.R[i], 2)} degrees'
+                    yield f" Y{round(current_y, 2)}", f' and rotate wire {round(self.R[i], 2)} degrees', True
 
                 # previous bend was negative, need to duck and move to positive position
                 if (self.A[i] > .02) & (bender_position == 1):
-                    gcode.append("M106 P0 S1.0")
-                    comment.append(f';  Ducking pin for positive bend')
-                    gcode.append("G0 Z-30")
-                    comment.append(f'')
-                    gcode.append("M106 P0 S0")
-                    comment.append(f'')
-                    gcode.append("G4 P80")
-                    comment.append(f'')
+                    yield "M106 P0 S1.0", ';  Ducking pin for positive bend', False
+                    yield "G0 Z-30", "", False
+                    yield "M106 P0 S0", "", False
+                    yield "G4 P80", "", False
                     bender_position = -1
                 elif (self.A[i] < -.02) & (bender_position == -1):
-                    gcode.append("M106 P0 S1.0")
-                    comment.append(f';  Ducking pin for negative bend')
-                    gcode.append("G0 Z30")
-                    comment.append(f'')
-                    gcode.append("M106 P0 S0")
-                    comment.append(f'')
-                    gcode.append("G4 P80")
-                    comment.append(f'')
+                    yield "M106 P0 S1.0", ';  Ducking pin for negative bend', False
+                    yield "G0 Z30", "", False
+                    yield "M106 P0 S0", "", False
+                    yield "G4 P80", "", False
                     bender_position = 1
 
                 # Check A value threshold
                 if abs(self.A[i]) > 0.02:  # Adjust the threshold as needed
-                    gcode.append(f"G1 Z{round(self.MA[i], 2)}")
-                    comment.append(f';  Setting motor angle to {round(self.MA[i], 2)} degrees for {round(self.A[i], 2)}'
-                                   f' degree desired bend')
+                    yield (f"G1 Z{round(self.MA[i], 2)}",
+                           f';  Setting motor angle to {round(self.MA[i], 2)} degrees for {round(self.A[i], 2)}'
+                           f' degree desired bend', False)
                     if self.A[i] < 0:
-                        gcode.append("G0 Z30")
-                        comment.append(f';  Return pin to positive position')
+                        yield "G0 Z30", ';  Return pin to positive position', False
                         bender_position = 1
                     elif self.A[i] > 0:
-                        gcode.append("G0 Z-30")
-                        comment.append(f';  Return pin to negative position')
+                        yield "G0 Z-30", ';  Return pin to negative position', False
                         bender_position = -1
 
-        gcode.append("M106 P0 S1.0")
-        comment.append(f';  Ducking pin')
+            i += 1
+
+        yield "M106 P0 S1.0", ';  Ducking pin', False
         if self.A[-1] < 0:
-            gcode.append("G0 Z90")
+            yield "G0 Z90", "", False
+        else:
+            yield "G0 Z-90", "", False
+        yield "M106 P0 S0", "", False
+
+        yield "%", "", False
+
+    # yields the loop of a roll section (see roll_sections.py) starting at X current_x and Y current_y, the pin is
+    # on the start side of the section's bends before and after it
+    def _roll_section_steps(self, section, current_x, current_y):
+        yield (f"while iterations < {section.count}",
+               f';  Roll section: {section.count} bends of {round(section.angle, 2)} degrees, '
+               f'{round(section.length, 2)} mm apart, radius {round(section.radius, 1)} mm', False)
+
+        move = f"  G0 X{loop_value(current_x + section.length, section.length)}"
+        move_comment = f';  Extrude wire {round(section.length, 2)} mm'
+        if abs(section.rotation * section.count) > 0.01:
+            move += f" Y{loop_value(current_y + section.rotation, section.rotation)}"
+            move_comment += f' and rotate wire {round(section.rotation, 2)} degrees'
+        yield move, move_comment, False
+
+        yield (f"  G1 Z{round(section.motor_angle, 2)}",
+               f';  Setting motor angle to {round(section.motor_angle, 2)} degrees for {round(section.angle, 2)}'
+               f' degree desired bend', False)
+
+        full_return, return_comment = (("G0 Z-30", ';  Return pin to negative position') if section.angle > 0
+                                       else ("G0 Z30", ';  Return pin to positive position'))
+        if section.return_angle is None:
+            yield "  " + full_return, return_comment, False
         else:
-            gcode.append("G0 Z-90")
-        comment.append(f'')
-        gcode.append("M106 P0 S0")
-        comment.append(f'')
+            yield f"  G0 Z{round(section.return_angle, 2)}", ';  Back the pin off the wire', False
+            yield full_return, return_comment, False
 
-        gcode.append("%")
-        comment.append("")
-        return [gcode, comment]
+    def stream_gcode(self, sink, comments=True, width=25):
+        """
+        Writes the G-code to sink line by line without building the whole program in memory, see write_lines.
+        Returns the number of lines written.
+        """
+        with INSTRUMENTS.stage("stream_gcode"):
+            count = BenderGCode.write_lines(sink, BenderGCode.format_lines(self.iter_gcode(), width, comments))
+        INSTRUMENTS.count("gcode_lines", count)
+        return count
+
+    # formats (gcode, comment) pairs one at a time, without comments the lines left empty are dropped
+    @staticmethod
+    def format_lines(lines, width=25, comments=True):
+        for line, line_comment in lines:
+            if comments:
+                yield f"{line.ljust(width)}{line_comment}"
+            elif line:
+                yield line
+
+    @staticmethod
+    def write_lines(sink, lines, buffer_size=WRITE_BUFFER_SIZE):
+        """
+        Writes formatted lines to sink and returns how many were written.
+
+        sink can be a file path, a text stream (an open file or io.StringIO), a binary stream (io.BytesIO or a
+        file opened with 'wb') or a connected socket. Binary sinks get ASCII with '\\n' line endings. Streams and
+        sockets are flushed but not closed.
+        """
+        if isinstance(sink, (str, os.PathLike)):
+            with open(sink, 'w', buffering=buffer_size) as file:
+                return BenderGCode.write_lines(file, lines)
+
+        if isinstance(sink, socket.socket):
+            with sink.makefile('wb', buffering=buffer_size) as stream:
+                return BenderGCode.write_lines(stream, lines)
+
+        if not isinstance(sink, io.TextIOBase):
+            text = io.TextIOWrapper(sink, encoding='ascii', newline='\n', write_through=False)
+            try:
+                return BenderGCode.write_lines(text, lines)
+            finally:
+                text.detach().flush()
+
+        count = 0
+        for line in lines:
+            sink.write(line)
+            sink.write('\n')
+            count += 1
+        sink.flush()
+        return count
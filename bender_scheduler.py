@@ -0,0 +1,324 @@
+"""
+This module feeds several wire benders from one computer.
+
+Parts (a coordinate CSV, a material and a wire diameter) are submitted to a BenderScheduler. Each part is calculated
+in a worker pool (load, convert_coords, calculate_bends and generate_gcode, the same steps as batch_cam.py) and the
+G-Code is handed to the first idle machine with the pin the part was calculated for. A part can only be submitted
+for a pin that one of the machines has, the G-Code of a part is only valid for that pin. Like in the GUI, wire thicker
+than 2.6 mm can not be bent on the 12 mm pin.
+
+Machines are either real benders reached over the network (NetworkMachine, see gcode_sender.py) or simulated ones
+(SimulatedMachine) that take a fixed time per command, for trying out a setup without hardware:
+    python bender_scheduler.py parts/ --material "Galvanized Steel - 2mm.csv" --diameter 2 --simulate A:16.5 B:16.5 C:12
+
+Anderson Boyer
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from batch_cam import resolve_material
+from bender_gcode import BenderGCode
+from gcode_sender import DEFAULT_WINDOW, command_lines, connect
+from import_coords import ImportCoords
+from orientation_cost import DEFAULT_WEIGHTS
+
+PIN_TOLERANCE = .05  # mm, pin positions closer than this are the same pin
+SMALL_PIN_MAX_DIAMETER = 2.6  # mm, thicker wire needs a pin further out than 12 mm, same as the GUI
+JOB_STATES = ("queued", "computing", "waiting", "running", "done", "failed")
+
+
+# True if wire of this diameter can be bent with the pin, the same check as the GUI
+def pin_allows(pin_pos, diameter):
+    return pin_pos >= 12.1 or diameter <= SMALL_PIN_MAX_DIAMETER
+
+
+# calculates a part in a worker process, returns the G-Code commands and the orientation that was used
+def compute_job(csv_path, material_file, diameter, pin_pos):
+    coords = ImportCoords()
+    coords.load_file(csv_path)
+    if len(coords.point_objects) == 0:
+        raise ValueError(f"no coordinates could be read from {csv_path}")
+    # fewest collisions, then lowest cost, the same choice as the GUI
+    best_idx = coords.calculate_best_orientation(material_file, diameter, pin_pos, weights=DEFAULT_WEIGHTS,
+                                                 collisions_first=True)
+    points = coords.point_objects[best_idx]
+    commands = list(command_lines(BenderGCode(points).iter_gcode()))
+    return commands, best_idx + 1, points.collision_count
+
+
+class Job:
+    """
+    One part going through the scheduler. state is one of JOB_STATES, machine is the name of the machine that bent
+    it and error the reason it failed. The timestamps are time.monotonic() values, None until the state is reached.
+    """
+    def __init__(self, number, csv_path, material_file, diameter, pin_pos):
+        self.number = number
+        self.name = os.path.splitext(os.path.basename(csv_path))[0]
+        self.csv_path, self.material_file = csv_path, material_file
+        self.diameter, self.pin_pos = diameter, pin_pos
+        self.state = "queued"
+        self.machine = None
+        self.commands = None
+        self.orientation = self.collisions = None
+        self.error = None
+        self.submitted = time.monotonic()
+        self.computed = self.started = self.finished = None
+        self.done = asyncio.get_running_loop().create_future()
+
+    def __repr__(self):
+        return f"Job({self.number}, {self.name!r}, {self.state})"
+
+
+class SimulatedMachine:
+    """
+    Stand-in for a bender that takes seconds_per_command for every command it is sent.
+    """
+    def __init__(self, name, pin_pos, seconds_per_command=.01):
+        self.name, self.pin_pos = name, pin_pos
+        self.seconds_per_command = seconds_per_command
+        self.jobs_run = 0
+
+    async def run(self, job):
+        await asyncio.sleep(len(job.commands) * self.seconds_per_command)
+        self.jobs_run += 1
+
+
+class NetworkMachine:
+    """
+    A bender reached over telnet or http, see gcode_sender.connect. The blocking sender runs in a thread.
+    """
+    def __init__(self, name, pin_pos, host, protocol="telnet", port=None, window=DEFAULT_WINDOW):
+        self.name, self.pin_pos = name, pin_pos
+        self.host, self.protocol, self.port, self.window = host, protocol, port, window
+        self.jobs_run = 0
+
+    def _send(self, commands):
+        with connect(self.host, self.protocol, self.port, self.window) as sender:
+            return sender.send(commands)
+
+    async def run(self, job):
+        await asyncio.to_thread(self._send, job.commands)
+        self.jobs_run += 1
+
+
+class BenderScheduler:
+    """
+    Calculates submitted parts in a process pool and runs them on the machines, see the module docstring.
+
+    Use as an async context manager, or call start and close:
+        async with BenderScheduler(machines) as scheduler:
+            job = scheduler.submit("part.csv", "Mild Steel - 3mm.csv", 3, 16.5)
+            await scheduler.join()
+    """
+    def __init__(self, machines, workers=None, executor=None):
+        if not machines:
+            raise ValueError("at least one machine is needed")
+        self.machines = list(machines)
+        self.pins = sorted({machine.pin_pos for machine in self.machines})
+        self.workers = workers
+        self._executor = executor
+        self._own_executor = executor is None
+        self._queues = {}
+        self._tasks = []
+        self._computing = set()
+        self.jobs = []
+        self.max_waiting = {pin: 0 for pin in self.pins}
+
+    # returns the pin of the machines that matches pin_pos, None if no machine has it
+    def _pin_for(self, pin_pos):
+        for pin in self.pins:
+            if abs(pin - pin_pos) < PIN_TOLERANCE:
+                return pin
+        return None
+
+    async def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._queues = {pin: asyncio.Queue() for pin in self.pins}
+        self._tasks = [asyncio.create_task(self._machine_loop(machine)) for machine in self.machines]
+        return self
+
+    async def close(self):
+        tasks = self._tasks + list(self._computing)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        # jobs still waiting in a queue were never taken by a machine
+        for job in self.jobs:
+            if not job.done.done():
+                self._finish(job, "failed", "cancelled")
+        if self._own_executor and self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def submit(self, csv_path, material_file, diameter, pin_pos):
+        """
+        Adds a part and returns its Job, await job.done to wait for it. Raises ValueError if no machine has the pin
+        or if the wire is too thick for the pin.
+        """
+        pin = self._pin_for(pin_pos)
+        if pin is None:
+            raise ValueError(f"no machine has a {pin_pos} mm pin, the machines have {self.pins}")
+        if not pin_allows(pin, diameter):
+            raise ValueError(f"{diameter} mm wire can not be bent with the {pin} mm pin, it needs the 16.5 mm pin")
+
+        job = Job(len(self.jobs) + 1, csv_path, material_file, diameter, pin)
+        self.jobs.append(job)
+        task = asyncio.create_task(self._compute(job))
+        self._computing.add(task)
+        task.add_done_callback(self._computing.discard)
+        return job
+
+    def _finish(self, job, state, error=None):
+        job.state, job.error = state, error
+        job.finished = time.monotonic()
+        if not job.done.done():
+            job.done.set_result(job)
+
+    async def _compute(self, job):
+        job.state = "computing"
+        loop = asyncio.get_running_loop()
+        try:
+            job.commands, job.orientation, job.collisions = await loop.run_in_executor(
+                self._executor, compute_job, job.csv_path, job.material_file, job.diameter, job.pin_pos)
+        except asyncio.CancelledError:
+            self._finish(job, "failed", "cancelled")
+            raise
+        except Exception as e:
+            self._finish(job, "failed", f"{type(e).__name__}: {e}")
+            return
+
+        job.state = "waiting"
+        job.computed = time.monotonic()
+        queue = self._queues[job.pin_pos]
+        queue.put_nowait(job)
+        self.max_waiting[job.pin_pos] = max(self.max_waiting[job.pin_pos], queue.qsize())
+
+    # each machine takes the next job for its pin whenever it is idle
+    async def _machine_loop(self, machine):
+        queue = self._queues[machine.pin_pos]
+        while True:
+            job = await queue.get()
+            job.state, job.machine = "running", machine.name
+            job.started = time.monotonic()
+            try:
+                await machine.run(job)
+            except asyncio.CancelledError:
+                self._finish(job, "failed", "cancelled")
+                raise
+            except Exception as e:
+                self._finish(job, "failed", f"{machine.name}: {type(e).__name__}: {e}")
+            else:
+                self._finish(job, "done")
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        """
+        Waits until every submitted job is done or failed and returns the jobs.
+        """
+        if self.jobs:
+            await asyncio.gather(*(job.done for job in self.jobs))
+        return self.jobs
+
+    def metrics(self):
+        """
+        Returns the number of jobs in each state, the jobs waiting for each pin (now and at most), how many jobs
+        each machine ran and the mean time jobs spent waiting for a machine in seconds.
+        """
+        states = {state: 0 for state in JOB_STATES}
+        for job in self.jobs:
+            states[job.state] += 1
+        waits = [job.started - job.computed for job in self.jobs if job.started is not None]
+        return {
+            "states": states,
+            "waiting": {pin: queue.qsize() for pin, queue in self._queues.items()},
+            "max_waiting": dict(self.max_waiting),
+            "machines": {machine.name: machine.jobs_run for machine in self.machines},
+            "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+        }
+
+
+# parses NAME:PIN or NAME:PIN:HOST[:PROTOCOL] machine arguments
+def parse_machine(text, simulated, seconds_per_command):
+    fields = text.split(":")
+    if simulated and len(fields) == 2:
+        return SimulatedMachine(fields[0], float(fields[1]), seconds_per_command)
+    if not simulated and len(fields) in (3, 4):
+        return NetworkMachine(fields[0], float(fields[1]), fields[2], *fields[3:])
+    raise ValueError(f"bad machine {text!r}")
+
+
+async def run_directory(input_dir, material_file, diameter, pin_pos, machines, workers=None, log=print):
+    """
+    Runs every .csv file in input_dir through a scheduler, pin_pos None spreads the parts over the machine pins
+    that can bend the diameter. Returns the jobs and the final metrics.
+    """
+    material_file = resolve_material(material_file)
+    csv_files = sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                       if name.lower().endswith(".csv"))
+    async with BenderScheduler(machines, workers) as scheduler:
+        pins = [pin_pos] if pin_pos is not None else [pin for pin in scheduler.pins if pin_allows(pin, diameter)]
+        if not pins:
+            raise ValueError(f"none of the machine pins {scheduler.pins} can bend {diameter} mm wire")
+        jobs = [scheduler.submit(csv_path, material_file, diameter, pins[idx % len(pins)])
+                for idx, csv_path in enumerate(csv_files)]
+        for finished in asyncio.as_completed([job.done for job in jobs]):
+            job = await finished
+            if job.state == "done":
+                log(f"{job.name}: {job.machine}, {len(job.commands)} commands, orientation {job.orientation}, "
+                    f"{job.finished - job.submitted:.2f} s")
+            else:
+                log(f"{job.name}: FAILED ({job.error})")
+        return jobs, scheduler.metrics()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate a directory of parts and bend them on several machines")
+    parser.add_argument("input_dir", help="directory containing the part CSV files")
+    parser.add_argument("--material", required=True, help="material CSV, either a path or a file in Materials/")
+    parser.add_argument("--diameter", type=float, required=True, help="wire diameter in mm")
+    parser.add_argument("--pin-pos", type=float, default=None,
+                        help="pin every part is calculated for (default: spread the parts over the machine pins)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    machines = parser.add_mutually_exclusive_group(required=True)
+    machines.add_argument("--machine", nargs="+", metavar="NAME:PIN:HOST[:PROTOCOL]",
+                          help="benders on the network, PROTOCOL is telnet (default) or http")
+    machines.add_argument("--simulate", nargs="+", metavar="NAME:PIN", help="simulated benders")
+    parser.add_argument("--seconds-per-command", type=float, default=.01,
+                        help="time a simulated bender takes per command (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    simulated = args.simulate is not None
+    try:
+        machine_list = [parse_machine(text, simulated, args.seconds_per_command)
+                        for text in (args.simulate if simulated else args.machine)]
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    try:
+        jobs, metrics = asyncio.run(run_directory(args.input_dir, args.material, args.diameter, args.pin_pos,
+                                                  machine_list, args.workers))
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'{len(jobs)} parts in {time.perf_counter() - start:.2f} s, {metrics["states"]["failed"]} failed, '
+          f'mean wait for a machine {metrics["mean_wait"]:.2f} s')
+    for name, count in metrics["machines"].items():
+        print(f"  {name}: {count} parts")
+    return 1 if metrics["states"]["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,343 @@
+"""
+This module contains the model of the space taken up by the machine, used to check a part for collisions while it
+is being bent.
+
+A MachineEnvelope is a list of boxes in the machine coordinate system (the bend die at the origin, the wire coming
+out along +Y). Points are tested against every box in one NumPy operation and the result says which points
+collided, with which box and where.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import math
+import numpy as np
+
+# point_index and box_index are arrays with one entry per point found inside a box, position is (n, 3)
+CollisionReport = namedtuple("CollisionReport", ["vertex", "point_index", "box_index", "position"])
+
+
+class Box:
+    """
+    Axis aligned box given by its lower and upper corner in mm. Points on the faces are outside.
+    """
+    def __init__(self, lower, upper, name=""):
+        self.lower = np.array(lower, dtype=np.float64)
+        self.upper = np.array(upper, dtype=np.float64)
+        self.name = name
+
+    @classmethod
+    def from_limits(cls, limits, name=""):
+        # limits in the {'x': [min, max], 'y': [min, max], 'z': [min, max]} form
+        return cls([limits['x'][0], limits['y'][0], limits['z'][0]],
+                   [limits['x'][1], limits['y'][1], limits['z'][1]], name)
+
+    def contains(self, points):
+        points = np.asarray(points)
+        return np.all((points > self.lower) & (points < self.upper), axis=-1)
+
+    def __repr__(self):
+        return f"Box({self.lower.tolist()}, {self.upper.tolist()}, name={self.name!r})"
+
+
+class MachineEnvelope:
+    def __init__(self, boxes=()):
+        self.boxes = list(boxes)
+        self._update_bounds()
+
+    @classmethod
+    def default(cls):
+        # collision area in mm
+        # coordinate system same as machine
+        return cls([Box.from_limits({
+            'x': [-150, 150],
+            'y': [-1000, -5],
+            'z': [-100, -5]
+        }, "machine body")])
+
+    def add_box(self, box):
+        self.boxes.append(box)
+        self._update_bounds()
+
+    def _update_bounds(self):
+        # (B, 3) arrays so every box is tested at once by broadcasting
+        self.lower = np.array([box.lower for box in self.boxes], dtype=np.float64).reshape(-1, 3)
+        self.upper = np.array([box.upper for box in self.boxes], dtype=np.float64).reshape(-1, 3)
+
+    def box_hits(self, points):
+        """
+        Returns an (N, B) boolean array, True where point n is inside box b.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 3)
+        return np.all((points > self.lower) & (points < self.upper), axis=-1)
+
+    def inside(self, points):
+        """
+        Returns an (N,) boolean array, True for every point that is inside any box.
+        """
+        return np.any(self.box_hits(points), axis=-1)
+
+    def any_inside(self, points):
+        return bool(np.any(self.box_hits(points)))
+
+    def check(self, points, index_offset=0, vertex=None):
+        """
+        Tests the points against every box and returns a CollisionReport, or None if nothing collided.
+
+        index_offset is added to the reported point indices, so a caller that passes points[start:] gets
+        indices into the full array back. vertex is stored in the report as is.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        point_index, box_index = np.nonzero(self.box_hits(points))
+        if len(point_index) == 0:
+            return None
+        return CollisionReport(vertex, point_index + index_offset, box_index, points[point_index])
+
+    def __repr__(self):
+        return f"MachineEnvelope({self.boxes!r})"
+
+
+def segment_box_hits(starts, ends, lower, upper):
+    """
+    Slab test of segments against open boxes.
+
+    starts and ends are (..., 3), lower and upper are (..., B, 3) and broadcast against them. Returns a (..., B)
+    boolean array, True where the segment passes through the inside of the box. Touching a face is not a hit.
+    """
+    starts = np.asarray(starts, dtype=np.float64)[..., None, :]
+    direction = np.asarray(ends, dtype=np.float64)[..., None, :] - starts
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (lower - starts) / direction
+        t2 = (upper - starts) / direction
+    t_low, t_high = np.minimum(t1, t2), np.maximum(t1, t2)
+
+    # a segment parallel to a slab is either inside it for its whole length or never
+    parallel = direction == 0
+    inside = (starts > lower) & (starts < upper)
+    t_low = np.where(parallel, np.where(inside, -np.inf, np.inf), t_low)
+    t_high = np.where(parallel, np.where(inside, np.inf, -np.inf), t_high)
+
+    enter = np.maximum(np.max(t_low, axis=-1), 0.0)
+    leave = np.minimum(np.min(t_high, axis=-1), 1.0)
+    return enter < leave
+
+
+def segment_distances(p1, q1, p2, q2):
+    """
+    Shortest distance between segments p1-q1 and p2-q2, all (N, 3), returns (N,).
+    """
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a = np.einsum('ij,ij->i', d1, d1)
+    e = np.einsum('ij,ij->i', d2, d2)
+    b = np.einsum('ij,ij->i', d1, d2)
+    c = np.einsum('ij,ij->i', d1, r)
+    f = np.einsum('ij,ij->i', d2, r)
+    denominator = a * e - b * b
+
+    # zero length and parallel segments fall back to the start of the first segment
+    safe_a = np.where(a > 1e-12, a, 1.0)
+    safe_e = np.where(e > 1e-12, e, 1.0)
+    safe_denominator = np.where(denominator > 1e-12, denominator, 1.0)
+
+    s = np.where(denominator > 1e-12, np.clip((b * f - c * e) / safe_denominator, 0, 1), 0.0)
+    t = np.where(e > 1e-12, (b * s + f) / safe_e, 0.0)
+
+    # clamp t to the second segment and recompute s for the clamped t
+    s = np.where(t < 0, np.where(a > 1e-12, np.clip(-c / safe_a, 0, 1), 0.0), s)
+    s = np.where(t > 1, np.where(a > 1e-12, np.clip((b - c) / safe_a, 0, 1), 0.0), s)
+    t = np.clip(t, 0, 1)
+
+    return np.linalg.norm(p1 + d1 * s[:, None] - p2 - d2 * t[:, None], axis=1)
+
+
+class SegmentSphereIndex:
+    """
+    Bounding sphere tree over the segments of a polyline for swept (capsule) collision checks.
+
+    Consecutive segments are grouped into leaves of leaf_size segments and the leaves are the bottom level of a
+    binary tree, so every node covers a run of consecutive segments and "segment k and later" is a range test on
+    a node. The tree is built once per part: spheres do not change under the rigid transforms used while bending,
+    so a check in any local frame only has to move sphere centres. "Segment k and later" is covered by the leaf
+    of k and the right siblings on its way up, all checks walk the tree together from there one level at a time,
+    a node is only opened if its sphere reaches a box, and only the segments of the leaves that are left get the
+    exact test. Segment j goes from points[j] to points[j + 1].
+    """
+    def __init__(self, points, leaf_size=4):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.segment_count = max(len(self.points) - 1, 0)
+        self.leaf_size = leaf_size
+        self.wire_length = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(self.points, axis=0), axis=1))))
+
+        # nodes in heap order: the children of node k are 2k + 1 and 2k + 2, the leaves are the last level
+        leaf_count = max(-(-self.segment_count // leaf_size), 1)
+        self.depth = int(math.ceil(math.log2(leaf_count)))
+        self.first_leaf = 2 ** self.depth - 1
+        node_count = 2 ** (self.depth + 1) - 1
+
+        # (leaves, leaf_size) segment indices, -1 past the last segment
+        self.leaf_segments = np.arange(2 ** self.depth * leaf_size).reshape(-1, leaf_size)
+        self.leaf_segments[self.leaf_segments >= self.segment_count] = -1
+
+        # first and last segment of every node, an empty node has first past the end and last -1
+        self.first = np.full(node_count, self.segment_count, dtype=np.int64)
+        self.last = np.full(node_count, -1, dtype=np.int64)
+        self.centers = np.zeros((node_count, 3))
+        self.radii = np.zeros(node_count)
+
+        leaves = slice(self.first_leaf, node_count)
+        used = self.leaf_segments[:, 0] >= 0
+        self.first[leaves] = np.where(used, self.leaf_segments[:, 0], self.segment_count)
+        self.last[leaves] = self.leaf_segments.max(axis=1)
+        if self.segment_count:
+            # the sphere around the end points of a leaf contains all of its segments
+            segments = np.where(self.leaf_segments >= 0, self.leaf_segments, self.segment_count - 1)
+            leaf_points = np.concatenate((self.points[segments], self.points[segments + 1]), axis=1)
+            centers = (leaf_points.min(axis=1) + leaf_points.max(axis=1)) / 2
+            self.centers[leaves] = np.where(used[:, None], centers, 0.0)
+            self.radii[leaves] = np.where(used, np.linalg.norm(leaf_points - centers[:, None], axis=2).max(axis=1), 0)
+
+        # every other level holds the smallest sphere around the spheres of its two children
+        for level in range(self.depth - 1, -1, -1):
+            nodes = np.arange(2 ** level - 1, 2 ** (level + 1) - 1)
+            self._merge(nodes, 2 * nodes + 1, 2 * nodes + 2)
+
+    def _merge(self, nodes, left, right):
+        self.first[nodes] = np.minimum(self.first[left], self.first[right])
+        self.last[nodes] = np.maximum(self.last[left], self.last[right])
+
+        c1, r1, c2, r2 = self.centers[left], self.radii[left], self.centers[right], self.radii[right]
+        distance = np.linalg.norm(c2 - c1, axis=1)
+        radius = (distance + r1 + r2) / 2
+        t = np.where(distance > 0, (radius - r1) / np.where(distance > 0, distance, 1), 0)
+        centers, radii = c1 + (c2 - c1) * t[:, None], radius
+
+        # one sphere inside the other, or an empty child
+        left_only = (r1 >= distance + r2) | (self.last[right] < 0)
+        right_only = ((r2 >= distance + r1) | (self.last[left] < 0)) & ~left_only
+        centers = np.where(left_only[:, None], c1, np.where(right_only[:, None], c2, centers))
+        self.centers[nodes] = centers
+        self.radii[nodes] = np.where(left_only, r1, np.where(right_only, r2, radii))
+
+    @staticmethod
+    def _near_boxes(centers, radii, lower, upper):
+        # True where a sphere reaches any box, centers (..., 3), radii (...), lower and upper (..., B, 3)
+        gap = np.maximum(lower - centers[..., None, :], 0) + np.maximum(centers[..., None, :] - upper, 0)
+        return np.any(np.einsum('...k,...k->...', gap, gap) < radii[..., None] ** 2, axis=-1)
+
+    @staticmethod
+    def _to_local(frames, origins, points):
+        # batched local = frame @ (point - origin), frames (n, 3, 3), origins and points (n, 3)
+        return np.einsum('pij,pj->pi', frames, points - origins)
+
+    def box_hits(self, origins, frames, first_segments, lower, upper, radius=0.0):
+        """
+        Capsule test of segments first_segments[c] and later against boxes, for C checks at once.
+
+        Check c moves the points into its local frame, local = frames[c] @ (point - origins[c]).
+        lower and upper are (B, 3) or per check (C, B, 3), they are grown by the capsule radius.
+        Returns a (C,) boolean array and, for every check that hit, a (check, segment indices, box indices) tuple,
+        ordered by check and segment.
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        frames = np.asarray(frames, dtype=np.float64)
+        first_segments = np.asarray(first_segments)
+        lower = np.broadcast_to(np.asarray(lower, dtype=np.float64) - radius, (len(origins),) + np.shape(lower)[-2:])
+        upper = np.broadcast_to(np.asarray(upper, dtype=np.float64) + radius, lower.shape)
+
+        hits = np.zeros(len(origins), dtype=bool)
+        if self.segment_count == 0:
+            return hits, []
+
+        # local = frame @ point - frame @ origin, the second part once per check
+        shifts = np.einsum('cij,cj->ci', frames, origins)
+
+        # segments first_segments[c] and later are covered by the leaf of the first one and the right siblings of
+        # the nodes above it, that way the spheres never include the segments before the check
+        node_idx = self.first_leaf + first_segments // self.leaf_size
+        check_idx = [np.arange(len(origins))]
+        nodes = [node_idx]
+        for _ in range(self.depth):
+            left = node_idx % 2 == 1
+            check_idx.append(np.flatnonzero(left))
+            nodes.append(node_idx[left] + 1)
+            node_idx = (node_idx - 1) // 2
+        check_idx, node_idx = np.concatenate(check_idx), np.concatenate(nodes)
+
+        # (check, node) pairs are opened until only leaves are left
+        leaf_checks, leaf_nodes = [], []
+        while len(node_idx):
+            keep = self.last[node_idx] >= first_segments[check_idx]
+            check_idx, node_idx = check_idx[keep], node_idx[keep]
+            centers = np.einsum('pij,pj->pi', frames[check_idx], self.centers[node_idx]) - shifts[check_idx]
+            keep = self._near_boxes(centers, self.radii[node_idx], lower[check_idx], upper[check_idx])
+            check_idx, node_idx = check_idx[keep], node_idx[keep]
+            leaf = node_idx >= self.first_leaf
+            leaf_checks.append(check_idx[leaf])
+            leaf_nodes.append(node_idx[leaf])
+            check_idx = np.repeat(check_idx[~leaf], 2)
+            node_idx = (2 * node_idx[~leaf, None] + np.array([1, 2])).ravel()
+        check_idx, node_idx = np.concatenate(leaf_checks), np.concatenate(leaf_nodes)
+
+        # exact test of every segment in the leaves that are left
+        check_idx = np.repeat(check_idx, self.leaf_size)
+        segment_idx = self.leaf_segments[node_idx - self.first_leaf].ravel()
+        keep = segment_idx >= first_segments[check_idx]
+        check_idx, segment_idx = check_idx[keep], segment_idx[keep]
+        starts = self._to_local(frames[check_idx], origins[check_idx], self.points[segment_idx])
+        ends = self._to_local(frames[check_idx], origins[check_idx], self.points[segment_idx + 1])
+        pair_idx, box_idx = np.nonzero(segment_box_hits(starts, ends, lower[check_idx], upper[check_idx]))
+
+        hit_checks = check_idx[pair_idx]
+        hits[hit_checks] = True
+        if len(hit_checks) == 0:
+            return hits, []
+
+        # the leaves were collected level by level, this puts the rows back in check and segment order
+        rows = np.column_stack((hit_checks, segment_idx[pair_idx], box_idx))
+        rows = rows[np.lexsort((rows[:, 2], rows[:, 1], rows[:, 0]))]
+        groups = np.split(rows, np.flatnonzero(np.diff(rows[:, 0])) + 1)
+        return hits, [(int(group[0, 0]), group[:, 1], group[:, 2]) for group in groups]
+
+    def self_intersections(self, radius):
+        """
+        Returns an (n, 2) array of segment pairs (j < k) of the polyline that come closer than two capsule radii,
+        sorted.
+
+        Segments less than pi wire diameters apart along the wire are neighbours, not a collision: the wire
+        can not fold back on itself any tighter than that. Pairs of nodes are opened one level at a time like in
+        box_hits, a pair is dropped once the spheres are too far apart or all of its segments are neighbours.
+        """
+        if self.segment_count < 3:
+            return np.zeros((0, 2), dtype=int)
+
+        min_separation = np.pi * 2 * radius
+        a = b = np.zeros(1, dtype=np.int64)
+        for level in range(self.depth + 1):
+            keep = (self.last[a] >= 0) & (self.last[b] >= 0)
+            # wire between the end of the first segment of a and the start of the last segment of b
+            keep &= self.wire_length[np.maximum(self.last[b], 0)] - self.wire_length[
+                np.minimum(self.first[a] + 1, self.segment_count)] >= min_separation
+            keep &= (np.linalg.norm(self.centers[a] - self.centers[b], axis=1)
+                     < self.radii[a] + self.radii[b] + 2 * radius)
+            a, b = a[keep], b[keep]
+            if level < self.depth:
+                # node a never comes after node b, so only child pairs in that order are needed
+                a = (2 * a[:, None] + np.array([1, 1, 2, 2])).ravel()
+                b = (2 * b[:, None] + np.array([1, 2, 1, 2])).ravel()
+                keep = a <= b
+                a, b = a[keep], b[keep]
+
+        segment_a = np.repeat(self.leaf_segments[a - self.first_leaf], self.leaf_size, axis=1).ravel()
+        segment_b = np.tile(self.leaf_segments[b - self.first_leaf], (1, self.leaf_size)).ravel()
+        keep = (segment_a >= 0) & (segment_b > segment_a)
+        segment_a, segment_b = segment_a[keep], segment_b[keep]
+        keep = self.wire_length[segment_b] - self.wire_length[segment_a + 1] >= min_separation
+        segment_a, segment_b = segment_a[keep], segment_b[keep]
+
+        distance = segment_distances(self.points[segment_a], self.points[segment_a + 1],
+                                     self.points[segment_b], self.points[segment_b + 1])
+        close = distance < 2 * radius
+        if not np.any(close):
+            return np.zeros((0, 2), dtype=int)
+        return np.unique(np.column_stack((segment_a[close], segment_b[close])), axis=0)
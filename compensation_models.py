@@ -0,0 +1,142 @@
+"""
+This module holds the compensation models that turn a desired bend angle into the motor angle (MA) that makes it.
+
+A model is fitted to the (motor angle, bend angle) pairs of a material file. The kinds are:
+- poly: the original cubic polynomial fit
+- pchip: monotone piecewise cubic interpolation through the averaged measurements, it follows the curve of long
+  tables closely and can not overshoot between the measurements
+- spline: cubic smoothing spline, for tables with a lot of scatter
+
+Bends in the positive and the negative direction get separate fits when the material file has measurements with a
+negative bend angle, otherwise the negative direction mirrors the positive one. Every fit keeps its residuals against
+the measurements. pchip and spline fits are compiled to a dense table over the measured bends so applying them is one
+np.interp call, outside of the measurements the slope at the first and the last one is continued.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import numpy as np
+from scipy.interpolate import PchipInterpolator, UnivariateSpline
+
+MODEL_KINDS = ("poly", "pchip", "spline")
+POLY_DEGREE = 3
+TABLE_NODES = 2048
+MIN_COMPENSATED_ANGLE = .05  # degrees, smaller bends are not made
+
+# residuals of one direction of a model, in degrees of motor angle
+FitResiduals = namedtuple("FitResiduals", ["direction", "samples", "rms", "max_abs"])
+
+
+# returns increasing bend angles and their motor angles from the measurements, with repeated measurements averaged
+# and the bend angle made non-decreasing in the motor angle so the result can be interpolated
+def monotone_samples(bend, motor):
+    order = np.lexsort((bend, motor))
+    bend, motor = bend[order], motor[order]
+
+    # average repeated measurements of the same motor angle
+    motor_values, first, counts = np.unique(motor, return_index=True, return_counts=True)
+    bend_means = np.add.reduceat(bend, first) / counts
+
+    # springback can not make a larger motor angle give a smaller bend, treat that as measurement noise
+    bend_means = np.maximum.accumulate(bend_means)
+
+    # of a run of equal bends (for example all the motor angles that do not bend the wire yet) keep the largest
+    # motor angle, the one just before the wire starts to bend
+    keep = np.append(bend_means[1:] > bend_means[:-1], True)
+    return bend_means[keep], motor_values[keep]
+
+
+class CompensationCurve:
+    """
+    Fit of motor angle against bend angle for one bend direction, both in degrees and positive.
+    """
+    def __init__(self, kind, bend, motor, table_nodes=TABLE_NODES):
+        if kind not in MODEL_KINDS:
+            raise ValueError(f"unknown compensation model {kind!r}, expected one of {MODEL_KINDS}")
+        self.kind = kind
+        self.coefficients = None
+
+        if kind == "poly":
+            self.coefficients = np.polyfit(bend, motor, POLY_DEGREE)
+        else:
+            knots_bend, knots_motor = monotone_samples(bend, motor)
+            if len(knots_bend) < 4:
+                raise ValueError(f"a {kind} compensation model needs at least 4 distinct measurements")
+            if kind == "pchip":
+                curve = PchipInterpolator(knots_bend, knots_motor, extrapolate=True)
+            else:
+                curve = UnivariateSpline(knots_bend, knots_motor, k=3)
+
+            # compile to a table over the measured bends, made non-decreasing because a smoothing spline can
+            # wiggle. Outside of it the end slopes are continued linearly, a cubic extrapolated below the first
+            # measurement turns around
+            self.table_bend = np.linspace(knots_bend[0], knots_bend[-1], table_nodes)
+            self.table_motor = np.maximum.accumulate(curve(self.table_bend))
+            derivative = curve.derivative()
+            self.start_slope = max(float(derivative(knots_bend[0])), 0.0)
+            self.end_slope = max(float(derivative(knots_bend[-1])), 0.0)
+
+    def __call__(self, angles):
+        if self.coefficients is not None:
+            return np.polyval(self.coefficients, angles)
+        angles = np.asarray(angles, dtype=np.float64)
+        flat = np.atleast_1d(angles)
+        motor = np.interp(flat, self.table_bend, self.table_motor)
+        below, beyond = flat < self.table_bend[0], flat > self.table_bend[-1]
+        motor[below] = self.table_motor[0] + self.start_slope * (flat[below] - self.table_bend[0])
+        motor[beyond] = self.table_motor[-1] + self.end_slope * (flat[beyond] - self.table_bend[-1])
+        return motor.reshape(angles.shape)
+
+
+class CompensationModel:
+    """
+    Compensation for both bend directions, see CompensationModel.fit. Calling the model with an array of signed
+    bend angles returns the signed motor angles.
+    """
+    def __init__(self, kind, positive, negative, residuals):
+        self.kind = kind
+        self.positive, self.negative = positive, negative
+        self.residuals = residuals
+
+    @classmethod
+    def fit(cls, compensation_data, kind="poly", per_direction=True, table_nodes=TABLE_NODES):
+        """
+        Fits a model to the rows (motor angle, bend angle) of a material file. With per_direction rows with a
+        negative bend angle are fitted on their own, if there are any.
+        """
+        motor, bend = compensation_data[:, 0], compensation_data[:, 1]
+        negative_rows = bend < 0
+        if not per_direction or not np.any(negative_rows):
+            negative_rows = np.zeros(len(bend), dtype=bool)
+        if np.all(negative_rows):
+            raise ValueError("the material file has no measurements of positive bends")
+
+        curves, residuals = [], []
+        for direction, rows in (("positive", ~negative_rows), ("negative", negative_rows)):
+            if not np.any(rows):
+                curves.append(curves[0])
+                continue
+            # the negative direction is fitted as a mirrored positive one
+            sign = 1 if direction == "positive" else -1
+            direction_bend, direction_motor = sign * bend[rows], sign * motor[rows]
+            curve = CompensationCurve(kind, direction_bend, direction_motor, table_nodes)
+            error = curve(direction_bend) - direction_motor
+            residuals.append(FitResiduals(direction, len(error), float(np.sqrt(np.mean(error ** 2))),
+                                          float(np.max(np.abs(error)))))
+            curves.append(curve)
+
+        return cls(kind, curves[0], curves[1], residuals)
+
+    def __call__(self, angles):
+        angles = np.asarray(angles, dtype=np.float64)
+        magnitude = np.abs(angles)
+        return np.where(angles < -MIN_COMPENSATED_ANGLE, -self.negative(magnitude),
+                        np.where(angles > MIN_COMPENSATED_ANGLE, self.positive(magnitude), 0.0))
+
+    def report(self):
+        """
+        Returns one line of text per fitted direction with the residuals of the fit.
+        """
+        return [f"{self.kind} {residual.direction}: {residual.samples} samples, rms {residual.rms:.3f} deg, "
+                f"max {residual.max_abs:.3f} deg" for residual in self.residuals]
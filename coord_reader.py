@@ -0,0 +1,120 @@
+"""
+This module reads coordinate CSV files (one x,y,z point per line) straight into an (N, 3) float64 array.
+
+The file is memory mapped and parsed in chunks of whole lines, so large exports from the digitizer are never held
+in memory as text and as Python floats at the same time. Chunks that are well formed are parsed by NumPy in one
+call, anything else is checked line by line so the error can say which line is wrong.
+
+Anderson Boyer
+"""
+
+import mmap
+import warnings
+import numpy as np
+
+CHUNK_SIZE = 1 << 22  # bytes
+UTF8_BOM = b'\xef\xbb\xbf'
+
+
+class CoordFileError(ValueError):
+    """
+    Raised when a coordinate file can not be read, line is the 1-based line number of the problem (None if the
+    problem is not with a single line).
+    """
+    def __init__(self, message, filename=None, line=None):
+        self.filename, self.line = filename, line
+        location = f"{filename}, line {line}" if line is not None else filename
+        super().__init__(f"{location}: {message}" if location else message)
+
+
+def read_coords(filename, chunk_size=CHUNK_SIZE):
+    """
+    Reads a coordinate CSV file and returns an (N, 3) float64 array.
+
+    Blank lines are skipped. Every other line must have exactly three comma separated numbers, otherwise a
+    CoordFileError with the line number is raised.
+    """
+    with open(filename, 'rb') as file:
+        if file.seek(0, 2) == 0:
+            raise CoordFileError("file is empty", filename)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _parse(data, filename, chunk_size)
+
+
+def _parse(data, filename, chunk_size):
+    size = len(data)
+    start = len(UTF8_BOM) if data[:len(UTF8_BOM)] == UTF8_BOM else 0
+    line_number = 1
+
+    # rough first guess of the number of rows, the buffer grows if the guess is too small
+    coords = np.empty((max(size // 24, 16), 3), dtype=np.float64)
+    count = 0
+
+    while start < size:
+        end = min(start + chunk_size, size)
+        if end < size:
+            # extend the chunk to the end of its last line
+            newline = data.find(b'\n', end)
+            end = size if newline == -1 else newline + 1
+        chunk = data[start:end]
+
+        values = _parse_chunk(chunk)
+        if values is None:
+            values = _parse_lines(chunk, filename, line_number)
+
+        if count + len(values) > len(coords):
+            coords = np.resize(coords, (max(2 * len(coords), count + len(values)), 3))
+        coords[count:count + len(values)] = values
+        count += len(values)
+
+        line_number += chunk.count(b'\n')
+        start = end
+
+    if count == 0:
+        raise CoordFileError("no coordinates found", filename)
+    return coords[:count].copy()
+
+
+# parses a chunk of well formed lines in one NumPy call, returns None if the chunk needs a closer look
+def _parse_chunk(chunk):
+    chunk = chunk.replace(b'\r', b'')
+    if chunk.endswith(b'\n'):
+        chunk = chunk[:-1]
+    lines = chunk.count(b'\n') + 1
+    if not chunk or b'\n\n' in chunk or chunk.count(b',') != 2 * lines:
+        return None
+    # the total is not enough, "1,2\n3,4,5,6" has it too: every line has to end after its second comma
+    buffer = np.frombuffer(chunk, dtype=np.uint8)
+    separators = buffer[(buffer == ord(',')) | (buffer == ord('\n'))]
+    if not np.all(separators[2::3] == ord('\n')):
+        return None
+
+    with warnings.catch_warnings():
+        # on text that is not a number older NumPy warns and stops early (caught by the length check below),
+        # newer NumPy raises
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            values = np.fromstring(chunk.replace(b'\n', b',').decode('ascii', 'replace'), dtype=np.float64, sep=',')
+        except ValueError:
+            return None
+    if len(values) != 3 * lines:
+        return None
+    return values.reshape(-1, 3)
+
+
+# line by line parsing for chunks with blank lines or errors
+def _parse_lines(chunk, filename, first_line):
+    rows = []
+    for offset, line in enumerate(chunk.split(b'\n')):
+        line = line.strip()
+        if not line:
+            continue
+        values = line.split(b',')
+        if len(values) != 3:
+            raise CoordFileError(f"expected 3 columns, found {len(values)}", filename, first_line + offset)
+        try:
+            rows.append([float(value) for value in values])
+        except ValueError:
+            raise CoordFileError(f"not a number: {line.decode('utf-8', 'replace')!r}", filename,
+                                 first_line + offset) from None
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
@@ -0,0 +1,160 @@
+"""
+This module estimates how long the bender takes to run a program made by BenderGCode.generate_gcode.
+
+The program is read once into arrays (one row per line) and the times are worked out for all lines together:
+- G0/G1 moves: every axis follows a trapezoidal speed profile (accelerate, cruise, decelerate) with the speed and
+  acceleration of its MachineProfile, the axes of one move start and stop together so the slowest axis sets the time.
+  An F word on a G1 caps the speed of the X axis (mm/min, as RepRapFirmware reads it).
+- G4: waits P milliseconds (or S seconds).
+- M106: the pin solenoid, takes solenoid_seconds.
+- G28 and M98 (homing and the pin setup macro) take fixed times from the profile.
+
+simulate returns the cycle time, the travel of each axis and a timeline with the start and duration of every line.
+It is fast enough to time all four orientations of a part, fastest_orientation picks the quickest one of the
+orientations without collisions.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import numpy as np
+
+from bender_gcode import BenderGCode
+from roll_sections import expand_loops
+
+AXES = ("X", "Y", "Z")
+
+# per line kinds in the timeline
+LINE_KINDS = ("none", "move", "dwell", "solenoid", "home", "macro", "other")
+
+Simulation = namedtuple("Simulation", ["seconds", "travel", "starts", "durations", "kinds"])
+
+
+class MachineProfile:
+    """
+    Speeds and accelerations of the bender axes: X feeds the wire (mm), Y rotates it (degrees) and Z swings the
+    bend pin (degrees). The defaults are rough values for the stock machine, measure a machine for real numbers.
+    """
+    def __init__(self, speeds=None, accelerations=None, solenoid_seconds=.02, home_seconds=5.0, macro_seconds=1.0):
+        self.speeds = {"X": 100.0, "Y": 360.0, "Z": 360.0}  # per second
+        self.accelerations = {"X": 1000.0, "Y": 2000.0, "Z": 3000.0}  # per second squared
+        self.speeds.update(speeds or {})
+        self.accelerations.update(accelerations or {})
+        self.solenoid_seconds = solenoid_seconds
+        self.home_seconds = home_seconds
+        self.macro_seconds = macro_seconds
+
+
+DEFAULT_PROFILE = MachineProfile()
+
+
+# reads the program into the line kinds, axis targets (NaN where an axis is not given), dwell times and feed rates
+def parse_program(gcode):
+    count = len(gcode)
+    kinds = np.zeros(count, dtype=np.int8)
+    targets = np.full((count, len(AXES)), np.nan)
+    dwell = np.zeros(count)
+    feed = np.full(count, np.nan)
+
+    for i, line in enumerate(gcode):
+        words = line.split(';', 1)[0].split()
+        if not words:
+            continue
+        command = words[0].upper()
+        values = {}
+        for word in words[1:]:
+            try:
+                values[word[0].upper()] = float(word[1:])
+            except ValueError:
+                pass
+
+        if command in ("G0", "G1"):
+            kinds[i] = 1
+            for axis_idx, axis in enumerate(AXES):
+                targets[i, axis_idx] = values.get(axis, np.nan)
+            if command == "G1" and "F" in values:
+                feed[i] = values["F"] / 60
+        elif command == "G4":
+            kinds[i] = 2
+            dwell[i] = values["P"] / 1000 if "P" in values else values.get("S", 0.0)
+        elif command == "M106":
+            kinds[i] = 3
+        elif command == "G28":
+            kinds[i] = 4
+        elif command == "M98":
+            kinds[i] = 5
+        else:
+            kinds[i] = 6
+    return kinds, targets, dwell, feed
+
+
+# time of a trapezoidal move of distance d with top speed v and acceleration a, element wise
+def move_times(distances, speeds, accelerations):
+    distances = np.abs(distances)
+    # distance needed to reach full speed and stop again
+    ramp = speeds ** 2 / accelerations
+    return np.where(distances >= ramp, distances / speeds + speeds / accelerations,
+                    2 * np.sqrt(distances / accelerations))
+
+
+def simulate(gcode, profile=DEFAULT_PROFILE):
+    """
+    Simulates a list of G-Code lines (or the [gcode, comment] lists from generate_gcode) and returns a Simulation:
+    the total seconds, the travel of each axis, and per line its start time, duration and index in LINE_KINDS.
+    All axes are at 0 at the start and after a G28. Roll section loops are unrolled first, the timeline has a line
+    for every bend of them.
+    """
+    if len(gcode) == 2 and isinstance(gcode[0], list):
+        gcode = gcode[0]
+    gcode = expand_loops(gcode)[0]
+    kinds, targets, dwell, feed = parse_program(gcode)
+    count = len(kinds)
+
+    # positions after every line: carry the last given target of each axis forward, reset to 0 by G28
+    given = ~np.isnan(targets) | (kinds == 4)[:, None]
+    values = np.where(kinds[:, None] == 4, 0.0, targets)
+    last_given = np.where(given, np.arange(count)[:, None], -1)
+    last_given = np.maximum.accumulate(last_given, axis=0)
+    positions = np.where(last_given >= 0, values[np.maximum(last_given, 0), np.arange(len(AXES))], 0.0)
+    previous = np.vstack((np.zeros((1, len(AXES))), positions[:-1]))
+    deltas = np.where(kinds[:, None] == 1, positions - previous, 0.0)
+
+    speeds = np.tile([profile.speeds[axis] for axis in AXES], (count, 1))
+    speeds[:, 0] = np.where(np.isnan(feed), speeds[:, 0], np.minimum(feed, speeds[:, 0]))
+    accelerations = np.array([profile.accelerations[axis] for axis in AXES])
+
+    durations = np.max(move_times(deltas, speeds, accelerations), axis=1)
+    durations = np.where(kinds == 1, durations, 0.0)
+    durations += dwell
+    durations += (kinds == 3) * profile.solenoid_seconds
+    durations += (kinds == 4) * profile.home_seconds
+    durations += (kinds == 5) * profile.macro_seconds
+
+    starts = np.cumsum(durations) - durations
+    travel = dict(zip(AXES, np.abs(deltas).sum(axis=0).tolist()))
+    return Simulation(float(durations.sum()), travel, starts, durations, kinds)
+
+
+def cycle_times(point_objects, profile=DEFAULT_PROFILE, gcode_strings=None):
+    """
+    Returns the simulated cycle time in seconds of every orientation. gcode_strings are the programs of the
+    orientations if they were generated already, the ones that are None (or all without it) are generated here.
+    """
+    gcode_strings = gcode_strings if gcode_strings is not None else [None] * len(point_objects)
+    return [simulate(gcode_string if gcode_string is not None else BenderGCode(points).generate_gcode(),
+                     profile).seconds for points, gcode_string in zip(point_objects, gcode_strings)]
+
+
+def fastest_orientation(point_objects, profile=DEFAULT_PROFILE, gcode_strings=None):
+    """
+    Returns the index of the fastest orientation without collisions, if every orientation has collisions the one with
+    the fewest (the fastest of those on a tie). Orientations that could not be calculated (no bends) are skipped.
+    gcode_strings as in cycle_times.
+    """
+    candidates = [i for i, points in enumerate(point_objects) if len(points.A) > 0]
+    if not candidates:
+        return 0
+    gcode_strings = gcode_strings if gcode_strings is not None else [None] * len(point_objects)
+    times = dict(zip(candidates, cycle_times([point_objects[i] for i in candidates], profile,
+                                             [gcode_strings[i] for i in candidates])))
+    return min(candidates, key=lambda i: (point_objects[i].collision_count, times[i]))
@@ -0,0 +1,201 @@
+"""
+This module shortens the program made by BenderGCode.generate_gcode without changing the part.
+
+generate_gcode writes every step on its own: a straight stretch of wire with vertices that are not bent becomes a
+feed move per vertex, and the pin is always sent back to its start side after a bend even when the next thing the
+program does is a ducked move somewhere else. optimize_gcode removes those steps:
+- consecutive feed/rotate moves (G0 with only X and Y) are merged into one move to the final X and Y
+- a pin return (G0 Z only) that is directly followed by a ducked pin move is dropped, the ducked move goes to the
+  new position anyway and the wire is not fed or rotated in between
+- a duck cycle that moves the pin to where it already is, and dwells after another dwell, are dropped
+
+Returns that are followed by a feed or a rotation are kept: they move the pin away from the leg that was just bent,
+which would otherwise be dragged into the pin as the wire is fed. The bends (the X and Y position at every G1 Z and
+its Z value) are compared before and after and the original program is returned if they differ.
+
+Roll section loops (see roll_sections.py) are left as they are, only the lines between them are optimized.
+The saving is estimated with the machine simulation in cycle_time.py.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+
+from cycle_time import DEFAULT_PROFILE, simulate
+from roll_sections import expand_loops
+
+DUCK_ON = "M106 P0 S1.0"
+DUCK_OFF = "M106 P0 S0"
+
+OptimizeReport = namedtuple("OptimizeReport", ["lines_before", "lines_after", "merged_moves", "removed_returns",
+                                               "removed_ducks", "seconds_before", "seconds_after", "seconds_saved"])
+
+
+# splits a G-Code line into its command and a dict of axis words, comments are ignored
+def parse_line(line):
+    words = line.split(';', 1)[0].split()
+    if not words:
+        return None, {}
+    values = {}
+    for word in words[1:]:
+        try:
+            values[word[0]] = float(word[1:])
+        except ValueError:
+            values[word[0]] = word[1:]
+    return words[0], values
+
+
+def _is_feed(line):
+    command, values = parse_line(line)
+    return command == "G0" and bool(values) and set(values) <= {"X", "Y"}
+
+
+def _is_return(line):
+    command, values = parse_line(line)
+    return command == "G0" and set(values) == {"Z"}
+
+
+def _format_move(values):
+    return "G0 " + " ".join(f"{axis}{_format_number(values[axis])}" for axis in ("X", "Y") if axis in values)
+
+
+# same number formatting as generate_gcode (str of a value rounded to 2 decimals)
+def _format_number(value):
+    return str(round(value, 2))
+
+
+def estimate_seconds(gcode, profile=DEFAULT_PROFILE):
+    """
+    Estimated run time of a list of G-Code lines, see cycle_time.simulate.
+    """
+    return simulate(gcode, profile).seconds
+
+
+def bend_sequence(gcode):
+    """
+    Returns the (X, Y, Z) position of every bend (G1 Z) and the final (X, Y), everything the part shape depends on.
+    """
+    gcode = expand_loops(gcode)[0]
+    position = {"X": 0.0, "Y": 0.0}
+    bends = []
+    for line in gcode:
+        command, values = parse_line(line)
+        if command in ("G0", "G1"):
+            for axis in ("X", "Y"):
+                if axis in values:
+                    position[axis] = values[axis]
+            if command == "G1" and "Z" in values:
+                bends.append((position["X"], position["Y"], values["Z"]))
+    return bends, (position["X"], position["Y"])
+
+
+# start is the (X, Y) position before the first line
+def _merge_feeds(gcode, comment, start=(0.0, 0.0)):
+    out_gcode, out_comment = [], []
+    merged = 0
+    position = {"X": start[0], "Y": start[1]}
+    start = dict(position)  # position before the last line written
+    for line, line_comment in zip(gcode, comment):
+        values = parse_line(line)[1]
+        if out_gcode and _is_feed(line) and _is_feed(out_gcode[-1]):
+            position.update(values)
+            out_gcode[-1] = _format_move({axis: position[axis] for axis in parse_line(out_gcode[-1])[1] | values})
+            out_comment[-1] = f';  Extrude wire {_format_number(position["X"] - start["X"])} mm'
+            if position["Y"] != start["Y"]:
+                out_comment[-1] += f' and rotate wire {_format_number(position["Y"] - start["Y"])} degrees'
+            merged += 1
+            continue
+
+        start = dict(position)
+        for axis in ("X", "Y"):
+            if isinstance(values.get(axis), float):
+                position[axis] = values[axis]
+        out_gcode.append(line)
+        out_comment.append(line_comment)
+    return out_gcode, out_comment, merged
+
+
+def _drop_returns(gcode, comment):
+    keep = [True] * len(gcode)
+    removed = 0
+    for i in range(len(gcode) - 2):
+        if _is_return(gcode[i]) and gcode[i + 1] == DUCK_ON and parse_line(gcode[i + 2])[0] == "G0":
+            keep[i] = False
+            removed += 1
+    return [line for line, k in zip(gcode, keep) if k], [text for text, k in zip(comment, keep) if k], removed
+
+
+# drops duck cycles (duck, move, unduck, optional dwell) that do not move the pin, and dwells right after a dwell
+def _drop_ducks(gcode, comment):
+    out_gcode, out_comment = [], []
+    removed = 0
+    z = None
+    i = 0
+    while i < len(gcode):
+        line = gcode[i]
+        command, values = parse_line(line)
+        if line == DUCK_ON and i + 2 < len(gcode) and gcode[i + 2] == DUCK_OFF:
+            target = parse_line(gcode[i + 1])[1].get("Z")
+            if target is not None and target == z:
+                end = i + 3
+                if end < len(gcode) and parse_line(gcode[end])[0] == "G4":
+                    end += 1
+                removed += 1
+                i = end
+                continue
+        if command == "G4" and out_gcode and parse_line(out_gcode[-1])[0] == "G4":
+            removed += 1
+            i += 1
+            continue
+        if command in ("G0", "G1") and isinstance(values.get("Z"), float):
+            z = values["Z"]
+        elif command == "G28":
+            z = None
+        out_gcode.append(line)
+        out_comment.append(comment[i])
+        i += 1
+    return out_gcode, out_comment, removed
+
+
+# splits a program into (loop, gcode, comment) chunks, loop is True for a roll section loop and its body
+def _split_loops(gcode, comment):
+    chunks = []
+    for line, line_comment in zip(gcode, comment):
+        loop = line.startswith("while iterations < ") or (line.startswith("  ") and chunks and chunks[-1][0])
+        if not chunks or chunks[-1][0] != loop or line.startswith("while iterations < "):
+            chunks.append((loop, [], []))
+        chunks[-1][1].append(line)
+        chunks[-1][2].append(line_comment)
+    return chunks
+
+
+def optimize_gcode(gcode_string, profile=DEFAULT_PROFILE):
+    """
+    Optimizes the [gcode, comment] lists from generate_gcode and returns the new lists and an OptimizeReport.
+    profile is the cycle_time.MachineProfile the saving is estimated with.
+    """
+    gcode, comment = list(gcode_string[0]), list(gcode_string[1])
+    seconds_before = estimate_seconds(gcode, profile)
+
+    merged = returns = ducks = 0
+    out_gcode, out_comment = [], []
+    for loop, chunk_gcode, chunk_comment in _split_loops(gcode, comment):
+        if not loop:
+            chunk_gcode, chunk_comment, chunk_merged = _merge_feeds(chunk_gcode, chunk_comment,
+                                                                    bend_sequence(out_gcode)[1])
+            chunk_gcode, chunk_comment, chunk_returns = _drop_returns(chunk_gcode, chunk_comment)
+            chunk_gcode, chunk_comment, chunk_ducks = _drop_ducks(chunk_gcode, chunk_comment)
+            merged, returns, ducks = merged + chunk_merged, returns + chunk_returns, ducks + chunk_ducks
+        out_gcode += chunk_gcode
+        out_comment += chunk_comment
+    gcode, comment = out_gcode, out_comment
+
+    if bend_sequence(gcode) != bend_sequence(gcode_string[0]):
+        # should not happen, but the part must never change
+        gcode, comment = list(gcode_string[0]), list(gcode_string[1])
+        merged = returns = ducks = 0
+
+    seconds_after = estimate_seconds(gcode, profile)
+    report = OptimizeReport(len(gcode_string[0]), len(gcode), merged, returns, ducks, seconds_before, seconds_after,
+                            seconds_before - seconds_after)
+    return [gcode, comment], report
@@ -0,0 +1,422 @@
+"""
+This module sends G-Code straight to the bender controller (a RepRapFirmware board, reached at wirebender.local)
+instead of going through a saved .gcode file.
+
+Two interfaces of the board are supported, both over one connection that stays open for the whole part:
+- telnet: every command is a line on a TCP stream and the controller answers each one with a line ending in the
+  ack token ("ok"). Up to window commands are sent before their acks have come back.
+- http: commands go through the rr_gcode request of the web interface. Each request carries as many commands as
+  fit in the free space of the controller's G-Code buffer (the "buff" value of every reply) and in window.
+
+For every command the time from sending it to its acknowledgement is kept. FakeController is a local stand-in for
+the board that speaks both interfaces, so the sender can be tried without a machine:
+    python gcode_sender.py part.gcode --fake
+
+Anderson Boyer
+"""
+
+import argparse
+from collections import deque, namedtuple
+import http.client
+import json
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+from roll_sections import iter_expanded
+
+DEFAULT_HOST = "wirebender.local"
+TELNET_PORT = 23
+HTTP_PORT = 80
+DEFAULT_WINDOW = 8
+DEFAULT_TIMEOUT = 30.0  # seconds to wait for an acknowledgement
+BUFFER_POLL_INTERVAL = .05  # seconds between polls while the controller buffer is full
+
+# one sent command, latency is the time from sending it to its acknowledgement in seconds
+SentLine = namedtuple("SentLine", ["number", "command", "latency", "reply"])
+
+
+class SendError(OSError):
+    """
+    Raised when the controller does not accept or acknowledge a command, number is the 1-based command number.
+    """
+    def __init__(self, message, number=None):
+        self.number = number
+        super().__init__(f"command {number}: {message}" if number is not None else message)
+
+
+# strips comments and blank lines from G-Code lines (strings or (gcode, comment) pairs) and yields the commands,
+# roll section loops are sent unrolled (the firmware only runs loops from files)
+def command_lines(lines):
+    pairs = ((line, "") if isinstance(line, str) else line for line in lines)
+    for line, _ in iter_expanded(pairs):
+        command = line.split(';', 1)[0].strip()
+        if command and command != '%':
+            yield command
+
+
+def latency_summary(sent):
+    """
+    Returns the number of commands and their mean, median and worst latency in seconds.
+    """
+    latencies = sorted(line.latency for line in sent)
+    if not latencies:
+        return {"lines": 0, "mean": 0.0, "median": 0.0, "max": 0.0}
+    return {"lines": len(latencies), "mean": sum(latencies) / len(latencies),
+            "median": latencies[len(latencies) // 2], "max": latencies[-1]}
+
+
+class TelnetSender:
+    """
+    Sends commands over the telnet interface with up to window commands waiting for their ack.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=TELNET_PORT, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+                 ack_token="ok"):
+        self.window = window
+        self.ack_token = ack_token
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._received = b''
+
+    # returns the next reply line, raises SendError on timeout or a closed connection
+    def _read_line(self, number):
+        while b'\n' not in self._received:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                raise SendError("no acknowledgement from the controller", number) from None
+            if not data:
+                raise SendError("the controller closed the connection", number)
+            self._received += data
+        line, self._received = self._received.split(b'\n', 1)
+        return line.decode('ascii', 'replace').strip()
+
+    def send(self, lines, on_line=None):
+        """
+        Sends the commands in lines (see command_lines) and returns a SentLine per command in order.
+        on_line is called with each SentLine as soon as it is acknowledged.
+        """
+        sent = []
+        in_flight = deque()  # (number, command, send time)
+        reply = []
+        commands = enumerate(command_lines(lines), start=1)
+        finished = False
+
+        while in_flight or not finished:
+            # fill the pipeline
+            while not finished and len(in_flight) < self.window:
+                entry = next(commands, None)
+                if entry is None:
+                    finished = True
+                    break
+                number, command = entry
+                self.sock.sendall(command.encode('ascii') + b'\n')
+                in_flight.append((number, command, time.perf_counter()))
+
+            if not in_flight:
+                break
+
+            # anything before the ack token is the reply text of the oldest command
+            number, command, sent_at = in_flight[0]
+            line = self._read_line(number)
+            if line != self.ack_token:
+                if line.lower().startswith("error"):
+                    raise SendError(line, number)
+                reply.append(line)
+                continue
+
+            in_flight.popleft()
+            result = SentLine(number, command, time.perf_counter() - sent_at, "\n".join(reply))
+            reply = []
+            sent.append(result)
+            if on_line:
+                on_line(result)
+
+        return sent
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HttpSender:
+    """
+    Sends commands through rr_gcode requests on one keep-alive HTTP connection. Commands are packed into a request
+    while they fit in the free buffer space reported by the controller and there are at most window of them.
+    If the buffer stays too full for the next command for timeout seconds (a stalled or paused controller) send
+    raises SendError.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=HTTP_PORT, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+                 password=""):
+        self.window = window
+        self.timeout = timeout
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.buffer_space = None
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        reply = self._request(f"/rr_connect?password={quote(password)}&time={quote(now)}")
+        if reply.get("err", 0) != 0:
+            raise SendError(f"the controller refused the connection (err {reply['err']})")
+
+    def _request(self, path, number=None):
+        try:
+            self.connection.request("GET", path)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise SendError(f"request failed: {e}", number) from None
+        if response.status != 200:
+            raise SendError(f"the controller answered HTTP {response.status}", number)
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            raise SendError("the controller sent an invalid reply", number) from None
+
+    # sends a block of commands, returns the free buffer space reported by the controller
+    def _send_block(self, block, number):
+        reply = self._request("/rr_gcode?gcode=" + quote("\n".join(block)), number)
+        if "buff" not in reply:
+            raise SendError("the controller did not acknowledge the commands", number)
+        return int(reply["buff"])
+
+    def send(self, lines, on_line=None):
+        """
+        Sends the commands in lines (see command_lines) and returns a SentLine per command in order.
+        Every command of a request gets the latency of that request. on_line is called with each SentLine.
+        """
+        sent = []
+        pending = deque(enumerate(command_lines(lines), start=1))
+        if self.buffer_space is None and pending:
+            self.buffer_space = self._send_block([], pending[0][0])
+
+        full_since = None
+        while pending:
+            block, size = [], 0
+            while pending and len(block) < self.window:
+                length = len(pending[0][1]) + 1
+                if block and size + length > self.buffer_space:
+                    break
+                block.append(pending.popleft())
+                size += length
+
+            first = block[0][0]
+            if size > self.buffer_space:
+                # not even one command fits, wait for the controller to work through its buffer
+                pending.extendleft(reversed(block))
+                full_since = full_since if full_since is not None else time.monotonic()
+                if time.monotonic() - full_since > self.timeout:
+                    raise SendError(f"the controller buffer stayed full for {self.timeout:g} s", first)
+                time.sleep(BUFFER_POLL_INTERVAL)
+                self.buffer_space = self._send_block([], first)
+                continue
+
+            full_since = None
+            sent_at = time.perf_counter()
+            self.buffer_space = self._send_block([command for _, command in block], first)
+            latency = time.perf_counter() - sent_at
+            for number, command in block:
+                result = SentLine(number, command, latency, "")
+                sent.append(result)
+                if on_line:
+                    on_line(result)
+
+        return sent
+
+    def close(self):
+        try:
+            self._request("/rr_disconnect")
+        except SendError:
+            pass
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connect(host=DEFAULT_HOST, protocol="telnet", port=None, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT):
+    """
+    Opens a sender for protocol "telnet" or "http", port None uses the default port of the protocol.
+    """
+    if protocol == "telnet":
+        return TelnetSender(host, port or TELNET_PORT, window, timeout)
+    if protocol == "http":
+        return HttpSender(host, port or HTTP_PORT, window, timeout)
+    raise ValueError(f"unknown protocol {protocol!r}, expected 'telnet' or 'http'")
+
+
+class FakeController:
+    """
+    Local stand-in for the controller for trying out the senders. It runs a telnet server and an HTTP server with
+    rr_connect, rr_gcode and rr_disconnect on free ports of 127.0.0.1 in background threads.
+
+    Every command takes command_delay seconds to execute and is appended to received. The HTTP side has a
+    buffer of buffer_size bytes that commands are executed from in the background, like the real board.
+    """
+    def __init__(self, command_delay=0.0, buffer_size=256):
+        self.command_delay = command_delay
+        self.buffer_size = buffer_size
+        self.received = []
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._work = threading.Condition(self._lock)
+        self._closed = False
+
+        controller = self
+
+        class TelnetHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for raw in self.rfile:
+                    command = raw.decode('ascii', 'replace').strip()
+                    if command:
+                        controller._execute(command)
+                        self.wfile.write(b"ok\n")
+
+        class HttpHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # send the headers and body of a reply in one segment
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query, keep_blank_values=True)
+                if url.path == "/rr_gcode":
+                    reply = {"buff": controller._queue_commands(query.get("gcode", [""])[0])}
+                elif url.path in ("/rr_connect", "/rr_disconnect"):
+                    reply = {"err": 0}
+                else:
+                    self.send_error(404)
+                    return
+                body = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.telnet_server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), TelnetHandler)
+        self.telnet_server.daemon_threads = True
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), HttpHandler)
+        self.http_server.daemon_threads = True
+        self.telnet_port = self.telnet_server.server_address[1]
+        self.http_port = self.http_server.server_address[1]
+
+        self._threads = [threading.Thread(target=server.serve_forever, daemon=True)
+                         for server in (self.telnet_server, self.http_server)]
+        self._threads.append(threading.Thread(target=self._run_queue, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _execute(self, command):
+        if self.command_delay:
+            time.sleep(self.command_delay)
+        with self._lock:
+            self.received.append(command)
+
+    # adds commands to the HTTP buffer, returns the free space left
+    def _queue_commands(self, text):
+        with self._work:
+            for command in text.split("\n"):
+                command = command.strip()
+                if command:
+                    self._queue.append(command)
+                    self._queued_bytes += len(command) + 1
+            self._work.notify()
+            return max(self.buffer_size - self._queued_bytes, 0)
+
+    def _run_queue(self):
+        while True:
+            with self._work:
+                while not self._queue and not self._closed:
+                    self._work.wait()
+                if self._closed:
+                    return
+                command = self._queue[0]
+            self._execute(command)
+            with self._work:
+                self._queue.popleft()
+                self._queued_bytes -= len(command) + 1
+
+    # blocks until every command sent over HTTP has been executed
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(.005)
+
+    def close(self):
+        with self._work:
+            self._closed = True
+            self._work.notify()
+        for server in (self.telnet_server, self.http_server):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send a G-Code file to the bender controller")
+    parser.add_argument("gcode_file", help=".gcode file to send, comments are stripped")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="controller address (default: %(default)s)")
+    parser.add_argument("--protocol", choices=("telnet", "http"), default="telnet")
+    parser.add_argument("--port", type=int, default=None, help="default: 23 for telnet, 80 for http")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help="commands sent ahead of their acknowledgement (default: %(default)s)")
+    parser.add_argument("--fake", action="store_true", help="send to a local fake controller instead")
+    parser.add_argument("--verbose", action="store_true", help="print every command with its latency")
+    args = parser.parse_args(argv)
+
+    with open(args.gcode_file) as file:
+        lines = file.readlines()
+
+    fake = FakeController() if args.fake else None
+    host = "127.0.0.1" if fake else args.host
+    port = (fake.telnet_port if args.protocol == "telnet" else fake.http_port) if fake else args.port
+
+    def show(line):
+        print(f"{line.number:5d}  {line.latency * 1000:8.2f} ms  {line.command}")
+
+    start = time.perf_counter()
+    try:
+        with connect(host, args.protocol, port, args.window) as sender:
+            sent = sender.send(lines, on_line=show if args.verbose else None)
+    except OSError as e:
+        print("Error:", e)
+        return 1
+    finally:
+        if fake:
+            fake.close()
+
+    summary = latency_summary(sent)
+    print(f'{summary["lines"]} commands in {time.perf_counter() - start:.2f} s, latency mean '
+          f'{summary["mean"] * 1000:.2f} ms, median {summary["median"] * 1000:.2f} ms, '
+          f'max {summary["max"] * 1000:.2f} ms')
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
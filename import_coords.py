@@ -12,19 +12,49 @@ Anderson Boyer
 """
 
 
-from tkinter import filedialog
 import copy
 import numpy as np
-from scipy.optimize import fsolve
+from coord_reader import CoordFileError, read_coords
+from instrumentation import INSTRUMENTS, call_instrumented
+from material_registry import MATERIALS
+from part_file import load_part, part_key, save_part
+from orientation_cost import collision_limit, rank_orientations, score_orientation
+from polyline_simplify import simplify_polyline
+from min_bend_dist import DEFAULT_TOLERANCE, get_min_bend_table, solve_min_bend_dist
 from point_object import PointObject
 import math
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+WORKER_BACKENDS = ("serial", "thread", "process")
+ORIENTATION_WORKERS = 4
+PROGRESS_INTERVAL = .1  # seconds between progress calls while waiting for the worker orientations
+
+# executors are kept between calls so the process backend only pays the start up cost once
+_executors = {}
 
 
 class ImportCoords:
-    def __init__(self, figure, canvas):
+    def __init__(self, figure=None, canvas=None, backend="serial", envelope=None, swept_collisions=False,
+                 compensation="poly", max_deviation=None, roll_sections=False, roll_clearance=None):
         # Initialize the Tkinter window
         self.point_objects = []
+        # how the four orientations are evaluated, one of WORKER_BACKENDS
+        self.backend = backend
+        # machine envelope given to every PointObject, None uses MachineEnvelope.default()
+        self.envelope = envelope
+        # test the wire segments as capsules instead of only the vertices, see PointObject.swept_collision_detection
+        self.swept_collisions = swept_collisions
+        # compensation model fitted to the material file, one of compensation_models.MODEL_KINDS
+        self.compensation = compensation
+        # vertices closer than this (mm) to the polyline without them are removed first, see polyline_simplify.py
+        self.max_deviation = max_deviation
+        # write constant curvature runs as loops, roll_clearance shortens the pin return in them, see roll_sections.py
+        self.roll_sections = roll_sections
+        self.roll_clearance = roll_clearance
+        # progress(text, done, total) is called during the calculations, it may raise to stop them
+        # see background_task.py
+        self.progress = None
         self.plotIdx = 0
         # Arrays to store parsed data
         self.x, self.y, self.z = [], [], []
@@ -36,34 +66,35 @@ class ImportCoords:
         self.point_objects = []
         self.x, self.y, self.z = [], [], []
         self.plotIdx = 0
-        self.figure.clear()
+        if self.figure is not None:
+            self.figure.clear()
         self.convertedBool = False
         self.compensation_coeff = np.zeros(2)
 
     def browse_files(self):
+        # tkinter is only imported here so the pipeline can run where Tk is not installed
+        from tkinter import filedialog
+
         # Open a file explorer dialog to select a file
         filename = filedialog.askopenfilename(initialdir="/", title="Select a File",
                                               filetypes=(("CSV files", "*.csv"), ("All files", "*.*")))
+        self.load_file(filename)
+        return os.path.basename(filename)
+
+    # reads a coordinate CSV into x, y, z and builds the four bend orientations, no GUI required
+    @INSTRUMENTS.timed("load_file")
+    def load_file(self, filename):
+        self.clear_file()
         try:
-            # Read the selected file and parse comma-separated values into i, j, and k arrays
-            with open(filename, 'r') as file:
-                self.clear_file()
-                lines = file.readlines()
-                for line in lines:
-                    values = line.strip().split(',')
-                    if len(values) == 3:
-                        self.x.append(float(values[0]))
-                        self.y.append(float(values[1]))
-                        self.z.append(float(values[2]))
-                    else:
-                        print("CSV must have 3 columns")
-                        break
-        except Exception as e:
+            coords = read_coords(filename)
+        except (OSError, CoordFileError) as e:
             # Handle file reading errors
             print("Error:", e)
+            coords = np.zeros((0, 3))
 
-        if len(self.x) > 0:
-            point_object = PointObject(self.x, self.y, self.z)
+        if len(coords) > 0:
+            self.x, self.y, self.z = coords.T.tolist()
+            point_object = PointObject.from_array(coords, self.envelope)
             self.point_objects.append(point_object)
             # Create deep copies of the first PointObject instance
             new_point_objects = [copy.deepcopy(self.point_objects[0]) for _ in range(3)]
@@ -71,7 +102,39 @@ class ImportCoords:
             self.point_objects.extend(new_point_objects)
         else:
             print("No data")
-        return os.path.basename(filename)
+
+    # hash of everything the calculated orientations depend on, see part_file.part_key
+    def part_key(self, diameter, pin_pos, material_file, **settings):
+        return part_key(np.column_stack((self.x, self.y, self.z)), diameter, pin_pos,
+                        os.path.join("Materials", material_file), envelope=self.envelope,
+                        swept_collisions=self.swept_collisions,
+                        max_deviation=self.max_deviation, roll_sections=self.roll_sections,
+                        roll_clearance=self.roll_clearance,
+                        compensation=self.compensation, **settings)
+
+    # saves the raw coordinates and all four calculated orientations to a .npz part file
+    def save_part_file(self, path, diameter, pin_pos, material_file):
+        save_part(path, self.part_key(diameter, pin_pos, material_file), np.column_stack((self.x, self.y, self.z)),
+                  self.point_objects)
+
+    def load_part_file(self, path, diameter, pin_pos, material_file):
+        """
+        Restores the four orientations from a part file written by save_part_file, but only if it was calculated
+        from the coordinates that are loaded now with the same diameter, pin position, material and settings.
+        Returns True if the orientations were restored, otherwise nothing is changed and False is returned.
+        """
+        try:
+            _, _, point_objects = load_part(path, self.part_key(diameter, pin_pos, material_file), self.envelope)
+        except (OSError, ValueError, KeyError) as e:
+            print("Error:", e)
+            return False
+
+        if point_objects is None:
+            return False
+        self.point_objects = point_objects
+        self.find_roll_sections()
+        self.convertedBool = True
+        return True
 
     def print_csv(self):
         # Check if there are elements in i, j, and k arrays
@@ -85,99 +148,74 @@ class ImportCoords:
             print("No data to print.")
         return text_array
 
-    def convert_coords(self, diameter, pin_pos):
+    @INSTRUMENTS.timed("convert_coords")
+    def convert_coords(self, diameter, pin_pos, min_bend_tolerance=DEFAULT_TOLERANCE):
 
-        bend_die_radius = 2.5
-
-        if len(self.point_objects) > 0:
-            self.point_objects[2].reverse_order_coord()
-            self.point_objects[3].reverse_order_coord()
-        else:
+        if len(self.point_objects) == 0:
             print("No PointObject instances to convert.")
             return
 
-        # minimum extrude distance handling
-        for points in self.point_objects:
-            i = 1
-            while i < len(points.X) - 1:
+        # orientations 3 and 4 are bent from the other end, 2 and 4 are flipped 180 degrees about Y
+        jobs = [(points, diameter, pin_pos, idx >= 2, idx % 2 == 1, min_bend_tolerance, self.max_deviation)
+                for idx, points in enumerate(self.point_objects)]
+        self.point_objects = map_orientations(ImportCoords.convert_orientation, jobs, self.backend,
+                                              self._progress("Converting orientations"))
 
-                if i < len(points.X) - 2:
-                    angle1 = self.calculate_angle(points, i)
-                    angle2 = self.calculate_angle(points, i + 1)
-                else:
-                    angle1 = 0
-                    angle2 = self.calculate_angle(points, i)
-
-                distance_euclidian = math.sqrt((points.X[i + 1] - points.X[i]) ** 2 +
-                                               (points.Y[i + 1] - points.Y[i]) ** 2 +
-                                               (points.Z[i + 1] - points.Z[i]) ** 2)
-
-                arc_length_prev = .5 * abs(angle2) * (
-                        bend_die_radius + diameter / 2)  # 1/2 arc length of next bend in mm
-                arc_length_next = .5 * abs(angle1) * (
-                        bend_die_radius + diameter / 2)  # 1/2 arc length of next bend in mm
-
-                if i >= len(points.X) - 2:
-                    distance = distance_euclidian + arc_length_prev - bend_die_radius
-                else:
-                    distance = distance_euclidian - arc_length_prev + arc_length_next
-
-                if distance < (self.min_bend_dist(diameter, pin_pos, angle2)):
-                    if i < len(points.X) - 2:
-                        del points.X[i + 1]
-                        del points.Y[i + 1]
-                        del points.Z[i + 1]
-                        points.deleted_vertices += 1
-                    else:
-                        i += 1
-                        self.extend_last_point(points, distance)
-
-                else:
-                    i += 1
-
-        # rotation of other pointObject instances into coordinate systems
-        for points in self.point_objects:
-            points.pin_pos = pin_pos
-            points.translate_to_origin(0)
+        self.convertedBool = True
+        self.update_gui()
 
-            rotation_matrix = points.rotation_matrix(points.find_rz2(1), 'z')
-            points.rotate(rotation_matrix)
+    # minimum extrusion filtering and rotation into the bender coordinate system for a single orientation
+    # returns the point object because the process backend works on a copy
+    @staticmethod
+    def convert_orientation(points, diameter, pin_pos, reverse, flip, min_bend_tolerance=DEFAULT_TOLERANCE,
+                            max_deviation=None):
+        ImportCoords.filter_orientation(points, diameter, pin_pos, reverse, min_bend_tolerance, max_deviation)
+        ImportCoords.transform_orientation(points, pin_pos, flip)
+        return points
 
-            rotation_matrix = points.rotation_matrix(points.find_rx2(1), 'x')
-            points.rotate(rotation_matrix)
+    # first half of convert_orientation: bending order and minimum extrusion filtering
+    @staticmethod
+    @INSTRUMENTS.timed("filter")
+    def filter_orientation(points, diameter, pin_pos, reverse, min_bend_tolerance=DEFAULT_TOLERANCE,
+                           max_deviation=None):
+
+        # minimum extrusion distance by angle, interpolated to within min_bend_tolerance mm of min_bend_dist
+        min_bend_dist = get_min_bend_table(diameter, pin_pos, min_bend_tolerance)
+
+        if reverse:
+            points.reverse_order_coord()
+
+        # minimum extrude distance handling, see polyline_simplify.py
+        points.points, report = simplify_polyline(points.points, diameter, min_bend_dist, max_deviation)
+        points.simplified_vertices = report.simplified_vertices
+        points.deleted_vertices += report.deleted_vertices
+        points.deviation = report.deviation
+        INSTRUMENTS.count("min_bend_lookups", max(len(points) + report.deleted_vertices - 2, 0))
+        INSTRUMENTS.count("deleted_vertices", report.deleted_vertices)
+        INSTRUMENTS.count("simplified_vertices", report.simplified_vertices)
+
+    # second half of convert_orientation: rotation into the bender coordinate system
+    @staticmethod
+    @INSTRUMENTS.timed("transform")
+    def transform_orientation(points, pin_pos, flip):
 
-            rotation_matrix = points.rotation_matrix(points.find_ry2(2), 'y')
-            points.rotate(rotation_matrix)
+        # rotation of the pointObject instance into the coordinate system
+        points.pin_pos = pin_pos
+        points.translate_to_origin(0)
 
-        rotation_matrix = self.point_objects[0].rotation_matrix(math.pi, 'y')
+        rotation_matrix = points.rotation_matrix(points.find_rz2(1), 'z')
+        points.rotate(rotation_matrix)
 
-        self.point_objects[1].rotate(rotation_matrix)
-        self.point_objects[3].rotate(rotation_matrix)
+        rotation_matrix = points.rotation_matrix(points.find_rx2(1), 'x')
+        points.rotate(rotation_matrix)
 
-        self.convertedBool = True
-        self.update_gui()
+        rotation_matrix = points.rotation_matrix(points.find_ry2(2), 'y')
+        points.rotate(rotation_matrix)
 
-    @staticmethod
-    def extend_last_point(point_object, distance):
-        # Ensure the arrays have the same length
-        if len(point_object.X) == len(point_object.Y) == len(point_object.Z) and len(point_object.X) >= 2:
-            # Calculate the direction vector between the last and second-to-last points
-            direction_vector = np.array(
-                [point_object.X[-1] - point_object.X[-2], point_object.Y[-1] - point_object.Y[-2],
-                 point_object.Z[-1] - point_object.Z[-2]])
-
-            # Normalize the direction vector
-            direction_vector /= np.linalg.norm(direction_vector)
-
-            # Extend the last point along the direction vector by the specified distance
-            extended_point = np.array(
-                [point_object.X[-1], point_object.Y[-1], point_object.Z[-1]]) + distance * direction_vector
-
-            # Update the last point in the arrays
-            point_object.X[-1], point_object.Y[-1], point_object.Z[-1] = extended_point
-        else:
-            print("Error: Arrays must have the same length and contain at least two points.")
+        if flip:
+            points.rotate(points.rotation_matrix(math.pi, 'y'))
 
+    @INSTRUMENTS.timed("plot3d")
     def plot3d(self, point_object, title, empty_bool, dark_theme=True):
         self.figure.clear()
         ax = self.figure.add_subplot(111, projection='3d')
@@ -250,75 +288,189 @@ class ImportCoords:
         # Redraw the canvas
         self.canvas.draw()
 
+    @INSTRUMENTS.timed("calculate_bends")
     def calculate_bends(self, material_file, diameter):
         self.compute_compensation_coefficients(material_file)
 
-        for points in self.point_objects:
-            points.find_bends(diameter)
-            points.apply_compensation(self.compensation_coeff)
-
-    def update_gui(self):
-        self.plot3d(self.point_objects[self.plotIdx], f'Bend Orientation {self.plotIdx + 1}', False)
-
-    # calculates the minimum extrusion length required to make a bend based off the bender settings and angle
-    @staticmethod
-    def min_bend_dist(diameter, pin_pos, angle):
-
-        bend_pin = 6
-        offset = .8
-        bend_die_radius = 2.5
-        arc_length = abs(angle) * (bend_die_radius + diameter / 2)
-
-        angle = abs(angle)
-
-        x0 = (2.5 + diameter) * np.sin(angle) + offset
-        y0 = (2.5 + diameter) * np.cos(angle) - (2.5 + diameter / 2)
-
-        a = np.tan(angle) * -1
-        b = -1
-        c = y0 - a * x0
+        # progress callbacks cannot be sent to another process, there only finished orientations are reported
+        count = len(self.point_objects)
+        jobs = [(points, diameter, self.compensation_coeff, self.swept_collisions,
+                 None if self.backend == "process" else self._progress(f"Orientation {idx + 1} of {count}, vertex"))
+                for idx, points in enumerate(self.point_objects)]
+        self.point_objects = map_orientations(ImportCoords.calculate_orientation_bends, jobs, self.backend,
+                                              self._progress("Calculating bends"))
+        self.find_roll_sections()
+
+    # finds the roll sections of the calculated orientations if they are enabled
+    def find_roll_sections(self, point_objects=None):
+        if self.roll_sections:
+            for points in point_objects if point_objects is not None else self.point_objects:
+                points.find_roll_sections(self.roll_clearance)
+
+    @INSTRUMENTS.timed("calculate_best_orientation")
+    def calculate_best_orientation(self, material_file, diameter, pin_pos, min_bend_tolerance=DEFAULT_TOLERANCE,
+                                   weights=None, collisions_first=False):
+        """
+        Lazy version of convert_coords followed by calculate_bends for when only the best orientation is needed.
+
+        Orientations are converted and solved one at a time. Without weights the best orientation is the one with
+        the fewest collisions: each one is abandoned as soon as its collision count reaches the lowest count so far,
+        because it can no longer win (a tie goes to the earlier orientation), and once an orientation without
+        collisions is found the rest are skipped. Only the winner gets compensation.
+
+        With weights (see orientation_cost.DEFAULT_WEIGHTS) the orientation with the lowest combined cost wins, an
+        orientation is abandoned once its collisions alone cost more than the best orientation so far.
+        With collisions_first as well the fewest collisions still win and the cost only decides between the
+        orientations with the lowest count, each one is abandoned once it has more collisions than the best so far.
+        The winner is selected as plotIdx and its index is returned.
+        """
+        if len(self.point_objects) == 0:
+            print("No PointObject instances to convert.")
+            return None
 
-        def func(x):
-            return [np.absolute(a * x[0] + b * x[1] + c) / np.sqrt(a ** 2 + b ** 2) - bend_pin / 2,
-                    np.sqrt(x[0] ** 2 + x[1] ** 2) - pin_pos]
+        self.compute_compensation_coefficients(material_file)
 
-        # better initial guesses using the circle of the pin path
-        x_guess = pin_pos * np.cos(angle - (0.2762 + .81 * angle / np.pi))
-        y_guess = pin_pos * -1 * np.sin(angle - (0.2762 + .81 * angle / np.pi))
+        best_idx, best_count, best_cost = 0, None, None
+        for idx, points in enumerate(self.point_objects):
+            if weights is None and best_count == 0:
+                break
+            if self.progress is not None:
+                self.progress("Converting orientation", idx + 1, len(self.point_objects))
+
+            points = self.convert_orientation(points, diameter, pin_pos, idx >= 2, idx % 2 == 1, min_bend_tolerance,
+                                              self.max_deviation)
+            self.point_objects[idx] = points
+
+            if weights is None:
+                limit = best_count
+            elif collisions_first:
+                limit = None if best_count is None else best_count + 1
+            else:
+                limit = collision_limit(best_cost, weights)
+            progress = self._progress(f"Orientation {idx + 1} of {len(self.point_objects)}, vertex")
+            if not points.find_bends(diameter, max_collisions=limit, swept=self.swept_collisions, progress=progress):
+                continue
+
+            if weights is None:
+                if best_count is None or points.collision_count < best_count:
+                    best_idx, best_count = idx, points.collision_count
+            else:
+                points.apply_compensation(self.compensation_coeff)
+                self.find_roll_sections([points])
+                cost = score_orientation(points, weights).cost
+                if collisions_first:
+                    better = (best_count is None or points.collision_count < best_count
+                              or (points.collision_count == best_count and cost < best_cost))
+                else:
+                    better = best_cost is None or cost < best_cost
+                if better:
+                    best_idx, best_count, best_cost = idx, points.collision_count, cost
 
-        root = fsolve(func, [x_guess, y_guess])
+        if weights is None:
+            self.point_objects[best_idx].apply_compensation(self.compensation_coeff)
+            self.find_roll_sections([self.point_objects[best_idx]])
 
-        distance = math.dist(root, [x0, y0]) + arc_length
+        self.plotIdx = best_idx
+        self.convertedBool = True
+        self.update_gui()
+        return best_idx
 
-        return distance
+    # scores of the calculated orientations, cheapest first, see orientation_cost.rank_orientations
+    def rank_orientations(self, weights=None):
+        return rank_orientations(self.point_objects, weights)
 
-    # returns angle between two segments in radians given an intersection index and a pointObject instance
     @staticmethod
-    def calculate_angle(point_object, idx):
-
-        # Calculate the angle between the vectors using atan2
-        start_vector = (point_object.X[idx] - point_object.X[idx - 1], point_object.Y[idx] - point_object.Y[idx - 1],
-                        point_object.Z[idx] - point_object.Z[idx - 1])
-        next_vector = (point_object.X[idx + 1] - point_object.X[idx], point_object.Y[idx + 1] - point_object.Y[idx],
-                       point_object.Z[idx + 1] - point_object.Z[idx])
+    def calculate_orientation_bends(points, diameter, compensation_coeff, swept_collisions=False, progress=None):
+        points.find_bends(diameter, swept=swept_collisions, progress=progress)
+        points.apply_compensation(compensation_coeff)
+        return points
+
+    # self.progress with the text filled in, as progress(done, total), or None without a progress callback
+    def _progress(self, text):
+        if self.progress is None:
+            return None
+        return lambda done, total: self.progress(text, done, total)
+
+    # copy without the plot for calculating in a worker thread (matplotlib may only be used from the Tk thread), the
+    # orientations are copied too so a cancelled calculation leaves this instance as it was
+    def detached_copy(self):
+        coords = copy.copy(self)
+        coords.figure, coords.canvas = None, None
+        coords.point_objects = copy.deepcopy(self.point_objects)
+        return coords
+
+    # takes over the calculated orientations of a detached_copy and plots the selected one
+    def take_results(self, coords):
+        self.point_objects, self.plotIdx = coords.point_objects, coords.plotIdx
+        self.convertedBool, self.compensation_coeff = coords.convertedBool, coords.compensation_coeff
+        self.update_gui()
 
-        cross_product = (
-            start_vector[1] * next_vector[2] - start_vector[2] * next_vector[1],
-            start_vector[2] * next_vector[0] - start_vector[0] * next_vector[2],
-            start_vector[0] * next_vector[1] - start_vector[1] * next_vector[0]
-        )
+    def update_gui(self):
+        # headless instances (batch runs) have no figure to draw on
+        if self.figure is None:
+            return
+        self.plot3d(self.point_objects[self.plotIdx], f'Bend Orientation {self.plotIdx + 1}', False)
 
-        dot_product = sum(a * b for a, b in zip(start_vector, next_vector))
-        return math.atan2(math.sqrt(sum(c ** 2 for c in cross_product)), dot_product)
+    # calculates the minimum extrusion length required to make a bend based off the bender settings and angle
+    # this is the exact fsolve solution, convert_coords uses the interpolated table from get_min_bend_table
+    @staticmethod
+    def min_bend_dist(diameter, pin_pos, angle):
+        return solve_min_bend_dist(diameter, pin_pos, angle)
 
-    # returns array of compensation coefficients given a filename
+    # returns the compensation model given a filename
     # x is the desired angle, y is the motor angle (MA)
+    # the fit is cached by the material registry and only redone when the file changes
+    @INSTRUMENTS.timed("compensation_model")
     def compute_compensation_coefficients(self, filename):
-        filepath = os.path.join("Materials", filename)
-        # Load csv
-        compensation_data = np.loadtxt(filepath, delimiter=",", dtype=str)
-        compensation_data = compensation_data.astype(float)
-
-        best_fit = np.polyfit(compensation_data[:, 1], compensation_data[:, 0], 3)
-
-        self.compensation_coeff = best_fit
+        self.compensation_coeff = MATERIALS.model(filename, self.compensation)
+
+
+def map_orientations(func, jobs, backend="serial", progress=None):
+    """
+    Calls func(*job) for every job and returns the results in order.
+
+    backend is "serial" (in this thread), "thread" or "process". The executors have one worker per orientation,
+    so the four orientations run at the same time and a part takes as long as its slowest orientation.
+    While INSTRUMENTS is enabled the numbers of the worker processes are merged into it.
+
+    progress(done, total) is called with the number of finished jobs, also every PROGRESS_INTERVAL seconds while
+    waiting. If it raises, the jobs that have not started yet are cancelled (running ones finish in the background)
+    and the exception is passed on.
+    """
+    if backend == "serial" or len(jobs) <= 1:
+        results = []
+        for job in jobs:
+            if progress is not None:
+                progress(len(results), len(jobs))
+            results.append(func(*job))
+        return results
+    if backend not in WORKER_BACKENDS:
+        raise ValueError(f"Unknown worker backend '{backend}', expected one of {WORKER_BACKENDS}")
+
+    executor = _executors.get(backend)
+    if executor is None:
+        executor_class = ThreadPoolExecutor if backend == "thread" else ProcessPoolExecutor
+        executor = _executors[backend] = executor_class(max_workers=ORIENTATION_WORKERS)
+    instrumented = backend == "process" and INSTRUMENTS.enabled
+    if instrumented:
+        futures = [executor.submit(call_instrumented, func, INSTRUMENTS.tracing, *job) for job in jobs]
+    else:
+        futures = [executor.submit(func, *job) for job in jobs]
+
+    if progress is not None:
+        try:
+            pending = set(futures)
+            while pending:
+                progress(len(futures) - len(pending), len(futures))
+                _, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    results = [future.result() for future in futures]
+    if instrumented:
+        for _, snapshot in results:
+            INSTRUMENTS.merge(snapshot)
+        results = [result for result, _ in results]
+    return results
@@ -0,0 +1,203 @@
+"""
+This module shows where the time of a calculation goes.
+
+INSTRUMENTS is shared by the whole program, like MATERIALS in material_registry.py. The pipeline reports to it:
+- stages: wall time and number of calls of named steps (load_file, convert_coords, find_bends, plot3d, ...)
+- counters: how often the expensive things happen (solver calls, frame rotations, collision checks, deleted
+  vertices, G-Code lines, ...)
+While it is disabled (the default) a stage is a shared do-nothing context manager and a count returns straight
+away, and the hot loops only report once per call, so leaving the calls in costs next to nothing.
+
+Optionally a cProfile of everything between enable and disable is captured, and a trace of every stage that can be
+opened in chrome://tracing or https://ui.perfetto.dev.
+
+Work done in other processes (the process backend of map_orientations, batch workers) is run through
+call_instrumented, which sends the worker's numbers back so they can be merged into the parent with merge.
+
+    INSTRUMENTS.enable(profile=True)
+    coords.convert_coords(3, 16.5)
+    INSTRUMENTS.write_report("report.json")
+
+Anderson Boyer
+"""
+
+import cProfile
+from contextlib import nullcontext
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+PROFILE_ROWS = 25  # functions listed in the report, by cumulative time
+
+
+class _Stage:
+    def __init__(self, instruments, name):
+        self.instruments, self.name = instruments, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instruments.add_time(self.name, self.start, time.perf_counter())
+
+
+class Instrumentation:
+    """
+    Collects stage times, counters and optionally a cProfile and a trace, see the module docstring.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._null_stage = nullcontext()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}  # name: [calls, seconds]
+            self.counters = {}
+            self.events = []  # trace events
+            self.profile_rows = []
+
+    def enable(self, profile=False, trace=False):
+        """
+        Starts collecting, with profile a cProfile of this thread is captured until disable.
+        """
+        self.enabled = True
+        self.tracing = trace
+        if profile and self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def disable(self):
+        self.enabled = False
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.profile_rows = self._profile_rows(self._profiler)
+            self._profiler = None
+
+    def stage(self, name):
+        """
+        Context manager timing the block as stage name.
+        """
+        if not self.enabled:
+            return self._null_stage
+        return _Stage(self, name)
+
+    def timed(self, name):
+        """
+        Decorator version of stage. The wrapper keeps the name of the function, so it can still be pickled for a
+        process pool.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Stage(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_time(self, name, start, end):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += end - start
+            if self.tracing:
+                self.events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6,
+                                    "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Returns the collected numbers as plain data (for sending them from a worker process), see merge.
+        """
+        with self._lock:
+            return {"stages": {name: list(entry) for name, entry in self.stages.items()},
+                    "counters": dict(self.counters), "events": list(self.events)}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, (calls, seconds) in snapshot["stages"].items():
+                entry = self.stages.setdefault(name, [0, 0.0])
+                entry[0] += calls
+                entry[1] += seconds
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            if self.tracing:
+                self.events.extend(snapshot["events"])
+
+    @staticmethod
+    def _profile_rows(profiler):
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        rows = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append({"function": f"{os.path.basename(filename)}:{line}({function})", "calls": calls,
+                         "seconds": own, "cumulative_seconds": cumulative})
+        rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+        return rows[:PROFILE_ROWS]
+
+    def report(self):
+        """
+        Returns the stages (calls and seconds, slowest first), the counters and the profile rows as a dict.
+        Stages run in worker processes are added up, so they can add up to more than the wall time.
+        """
+        with self._lock:
+            stages = {name: {"calls": calls, "seconds": seconds}
+                      for name, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1])}
+            return {"stages": stages, "counters": dict(sorted(self.counters.items())),
+                    "profile": list(self.profile_rows)}
+
+    def summary(self, stages=3):
+        """
+        One line for a status bar: the slowest stages and the counters.
+        """
+        report = self.report()
+        parts = [f"{name} {entry['seconds']:.2f} s" for name, entry in list(report["stages"].items())[:stages]]
+        parts += [f"{name.replace('_', ' ')} {amount}" for name, amount in report["counters"].items()]
+        return " | ".join(parts)
+
+    def write_report(self, path, **extra):
+        """
+        Writes report() and any extra keyword values as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump({**self.report(), **extra}, file, indent=1)
+
+    def write_trace(self, path):
+        """
+        Writes the trace events in the Chrome trace format.
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+INSTRUMENTS = Instrumentation()
+
+
+def call_instrumented(func, trace, *args):
+    """
+    Runs func(*args) in a worker process with INSTRUMENTS enabled and returns (result, snapshot). The parent merges
+    the snapshot with INSTRUMENTS.merge.
+    """
+    INSTRUMENTS.reset()
+    INSTRUMENTS.enable(trace=trace)
+    try:
+        result = func(*args)
+    finally:
+        INSTRUMENTS.disable()
+    return result, INSTRUMENTS.snapshot()
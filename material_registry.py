@@ -0,0 +1,100 @@
+"""
+This module keeps the fitted compensation models of the material files so they are not re-read and re-fitted on
+every bend calculation.
+
+A material file is a CSV of (motor angle, bend angle) pairs measured on the machine. The default model is a cubic fit
+of the motor angle as a function of the desired bend angle, the other models are in compensation_models.py.
+MaterialRegistry fits every file in the materials directory the first time it is used and after that only re-fits a
+file when its modification time changes, so a material that is edited while the program runs is picked up on the
+next calculation.
+
+Anderson Boyer
+"""
+
+import os
+import threading
+import numpy as np
+from compensation_models import MIN_COMPENSATED_ANGLE, POLY_DEGREE, CompensationModel
+
+MATERIALS_DIR = "Materials"
+
+
+# returns (motor angle, bend angle) columns of a material file as floats
+def read_material(path):
+    compensation_data = np.loadtxt(path, delimiter=",", dtype=str)
+    return compensation_data.astype(float)
+
+
+# returns the polynomial coefficients that map the desired bend angle to the motor angle (MA)
+def fit_material(compensation_data):
+    return np.polyfit(compensation_data[:, 1], compensation_data[:, 0], POLY_DEGREE)
+
+
+def motor_angles(compensation_coeff, angles):
+    """
+    Applies compensation to an array of bend angles in one call. compensation_coeff is either the polynomial from
+    fit_material or a CompensationModel. The polynomial is evaluated on the absolute angle and takes the sign of
+    the bend, bends within MIN_COMPENSATED_ANGLE of zero give a motor angle of 0.
+    """
+    if isinstance(compensation_coeff, CompensationModel):
+        return compensation_coeff(angles)
+    angles = np.asarray(angles, dtype=np.float64)
+    motor = np.polyval(compensation_coeff, np.abs(angles))
+    return np.where(angles < -MIN_COMPENSATED_ANGLE, -motor, np.where(angles > MIN_COMPENSATED_ANGLE, motor, 0.0))
+
+
+class MaterialRegistry:
+    """
+    Cache of fitted compensation models keyed by material file path. Safe to share between threads.
+    """
+    def __init__(self, directory=MATERIALS_DIR):
+        self.directory = directory
+        self._models = {}  # (absolute path, kind, per_direction) -> (mtime_ns, CompensationModel)
+        self._lock = threading.Lock()
+        self._scanned = set()  # (kind, per_direction) the whole directory was fitted for
+        self.fits = 0
+
+    def _path(self, material_file):
+        return os.path.abspath(os.path.join(self.directory, material_file))
+
+    # fits the model of every .csv file in the directory that is not cached yet, files that can not be read are left
+    # for later
+    def load_all(self, kind="poly", per_direction=True):
+        self._scanned.add((kind, per_direction))
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.lower().endswith(".csv"))
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                self._fit(name, kind, per_direction)
+            except (OSError, ValueError, IndexError):
+                pass
+
+    def model(self, material_file, kind="poly", per_direction=True):
+        """
+        Returns the CompensationModel of a material file (a name in the directory or any path), fitting it only if it
+        was never fitted or the file changed since. Raises OSError/ValueError if the file can not be read. The first
+        call for a kind of model fits the whole directory. See CompensationModel.fit.
+        """
+        if (kind, per_direction) not in self._scanned:
+            self.load_all(kind, per_direction)
+        return self._fit(material_file, kind, per_direction)
+
+    def _fit(self, material_file, kind, per_direction):
+        path = self._path(material_file)
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, kind, per_direction)
+        with self._lock:
+            cached = self._models.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+
+            model = CompensationModel.fit(read_material(path), kind, per_direction)
+            self._models[key] = (mtime, model)
+            self.fits += 1
+            return model
+
+
+# registry shared by everything that uses the default Materials directory
+MATERIALS = MaterialRegistry()
@@ -0,0 +1,151 @@
+"""
+This module calculates the minimum extrusion distance needed before a bend can be made.
+
+solve_min_bend_dist is the original calculation: it solves for the point where the bend pin touches the wire with
+fsolve. min_bend_dists solves the same line-circle tangency in closed form for a whole array of angles at once.
+The result only depends on the wire diameter, the pin position and the bend angle, so MinBendDistTable samples it once
+per machine setup and answers every later lookup by interpolation. get_min_bend_table keeps the most recently used
+tables so switching between materials does not rebuild them.
+
+Anderson Boyer
+"""
+
+from functools import lru_cache
+import math
+import warnings
+import numpy as np
+from scipy.optimize import fsolve
+
+from instrumentation import INSTRUMENTS
+
+BEND_PIN = 6
+OFFSET = .8
+BEND_DIE_RADIUS = 2.5
+
+DEFAULT_TOLERANCE = 1e-3  # mm
+MAX_CACHED_TABLES = 16
+
+
+# calculates the minimum extrusion length required to make a bend based off the bender settings and angle
+def solve_min_bend_dist(diameter, pin_pos, angle):
+    INSTRUMENTS.count("solver_calls")
+
+    arc_length = abs(angle) * (BEND_DIE_RADIUS + diameter / 2)
+
+    angle = abs(angle)
+
+    x0 = (2.5 + diameter) * np.sin(angle) + OFFSET
+    y0 = (2.5 + diameter) * np.cos(angle) - (2.5 + diameter / 2)
+
+    a = np.tan(angle) * -1
+    b = -1
+    c = y0 - a * x0
+
+    def func(x):
+        return [np.absolute(a * x[0] + b * x[1] + c) / np.sqrt(a ** 2 + b ** 2) - BEND_PIN / 2,
+                np.sqrt(x[0] ** 2 + x[1] ** 2) - pin_pos]
+
+    # better initial guesses using the circle of the pin path
+    x_guess = pin_pos * np.cos(angle - (0.2762 + .81 * angle / np.pi))
+    y_guess = pin_pos * -1 * np.sin(angle - (0.2762 + .81 * angle / np.pi))
+
+    root = fsolve(func, [x_guess, y_guess])
+
+    distance = math.dist(root, [x0, y0]) + arc_length
+
+    return distance
+
+
+def min_bend_dists(diameter, pin_pos, angles):
+    """
+    Closed form version of solve_min_bend_dist for an array of bend angles (radians), returns an array of distances.
+
+    The pin centre has to be BEND_PIN / 2 away from the wire line and pin_pos away from the bend die centre. The pin
+    pushes on the side of the wire away from the die, so its centre is on the parallel line BEND_PIN / 2 further
+    out, and it comes round the die from ahead of the wire, so of the two intersections of that line with the pin
+    circle it is the one further along the wire direction. This is the root solve_min_bend_dist converges to.
+    If the pin circle does not reach the line (a thick wire on the 12 mm pin at large angles) the bend can not be
+    made. solve_min_bend_dist then ends at the least squares compromise of its two equations, on the normal of the
+    wire halfway between the circle and the line, and so does this.
+    """
+    angles = np.abs(np.asarray(angles, dtype=np.float64))
+    sin, cos = np.sin(angles), np.cos(angles)
+
+    # point on the wire line, the line direction is (cos, -sin) and its normal is (sin, cos)
+    x0 = (2.5 + diameter) * sin + OFFSET
+    y0 = (2.5 + diameter) * cos - (2.5 + diameter / 2)
+
+    # offset of the line of pin centres along the normal, halfway to the circle where the circle does not reach it
+    k = sin * x0 + cos * y0 + BEND_PIN / 2
+    k = np.where(k > pin_pos, (k + pin_pos) / 2, k)
+    h = np.sqrt(np.clip(pin_pos ** 2 - k ** 2, 0, None))
+
+    root_x = k * sin + h * cos
+    root_y = k * cos - h * sin
+
+    arc_length = angles * (BEND_DIE_RADIUS + diameter / 2)
+    return np.hypot(root_x - x0, root_y - y0) + arc_length
+
+
+class MinBendDistTable:
+    """
+    Piecewise linear table of min_bend_dists over bend angles from 0 to pi for one (diameter, pin_pos).
+
+    The table starts coarse and is doubled until the value halfway between every pair of nodes is within
+    tolerance (mm) of the exact solution, or until max_nodes is reached. The checked midpoints are kept as
+    nodes. max_error is the largest error found at the midpoints in the last check, an estimate of the
+    interpolation error and not a bound: the error is only sampled at those points, not between them.
+
+    If max_nodes is reached before the tolerance is met (the distance has kinks where the pin stops reaching the
+    wire, see min_bend_dists) a RuntimeWarning is given and exact is set: every lookup then calls min_bend_dists
+    instead of interpolating.
+    """
+    def __init__(self, diameter, pin_pos, tolerance=DEFAULT_TOLERANCE, initial_nodes=33, max_nodes=4097):
+        self.diameter, self.pin_pos, self.tolerance = diameter, pin_pos, tolerance
+
+        angles = np.linspace(0, math.pi, initial_nodes)
+        distances = self._solve(angles)
+
+        while True:
+            midpoints = (angles[:-1] + angles[1:]) / 2
+            exact = self._solve(midpoints)
+            self.max_error = float(np.max(np.abs(np.interp(midpoints, angles, distances) - exact)))
+
+            # merge the checked midpoints into the table, they are exact values anyway
+            merged_angles = np.empty(len(angles) + len(midpoints))
+            merged_angles[0::2], merged_angles[1::2] = angles, midpoints
+            merged_distances = np.empty_like(merged_angles)
+            merged_distances[0::2], merged_distances[1::2] = distances, exact
+
+            angles, distances = merged_angles, merged_distances
+
+            if self.max_error <= tolerance or len(angles) >= max_nodes:
+                break
+
+        self.angles, self.distances = angles, distances
+        self.exact = self.max_error > tolerance
+        if self.exact:
+            warnings.warn(f"minimum bend distance table for diameter {diameter} mm and pin {pin_pos} mm is off by "
+                          f"{self.max_error:.3g} mm with {len(angles)} nodes, more than the tolerance of "
+                          f"{tolerance:g} mm, the exact solution is used instead", RuntimeWarning, stacklevel=2)
+
+    def _solve(self, angles):
+        INSTRUMENTS.count("min_bend_solves", len(angles))
+        return min_bend_dists(self.diameter, self.pin_pos, angles)
+
+    def __call__(self, angle):
+        if self.exact:
+            return float(min_bend_dists(self.diameter, self.pin_pos, angle))
+        return float(np.interp(abs(angle), self.angles, self.distances))
+
+    def lookup(self, angles):
+        if self.exact:
+            return min_bend_dists(self.diameter, self.pin_pos, angles)
+        return np.interp(np.abs(angles), self.angles, self.distances)
+
+
+# returns the table for a machine setup, the most recently used MAX_CACHED_TABLES setups are kept in memory
+@lru_cache(maxsize=MAX_CACHED_TABLES)
+def get_min_bend_table(diameter, pin_pos, tolerance=DEFAULT_TOLERANCE):
+    INSTRUMENTS.count("min_bend_tables")
+    return MinBendDistTable(float(diameter), float(pin_pos), tolerance)
@@ -0,0 +1,81 @@
+"""
+This module ranks the four bend orientations of a part by a weighted cost instead of by collision count alone.
+
+The cost of an orientation is the weighted sum of
+- collisions: collision_count
+- deleted_vertices: vertices removed because they were closer than the minimum bend distance
+- duck_cycles: times the pin is ducked under the wire (wear on the solenoid and pin)
+- rotation_travel: total wire rotation in degrees
+- cycle_seconds: simulated cycle time (see cycle_time.py)
+
+The weights are in seconds of machine time, so with the defaults a collision counts as 100 seconds and every
+second of cycle time as one. Everything is taken from one generated program per orientation.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import math
+
+from bender_gcode import BenderGCode
+from cycle_time import DEFAULT_PROFILE, simulate
+
+DEFAULT_WEIGHTS = {
+    "collisions": 100.0,
+    "deleted_vertices": 5.0,
+    "duck_cycles": .5,
+    "rotation_travel": .002,
+    "cycle_seconds": 1.0,
+}
+
+DUCK_ON = "M106 P0 S1.0"
+
+OrientationScore = namedtuple("OrientationScore", ["index", "cost", "collisions", "deleted_vertices", "duck_cycles",
+                                                   "rotation_travel", "cycle_seconds"])
+
+
+def score_program(collisions, deleted_vertices, gcode, weights=None, profile=DEFAULT_PROFILE, index=None):
+    """
+    Scores an orientation from its counts and its G-Code lines (or the [gcode, comment] lists of generate_gcode).
+    weights only needs the terms that differ from DEFAULT_WEIGHTS.
+    """
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    if len(gcode) == 2 and isinstance(gcode[0], list):
+        gcode = gcode[0]
+    simulation = simulate(gcode, profile)
+    terms = {
+        "collisions": collisions,
+        "deleted_vertices": deleted_vertices,
+        "duck_cycles": sum(1 for line in gcode if line == DUCK_ON),
+        "rotation_travel": simulation.travel["Y"],
+        "cycle_seconds": simulation.seconds,
+    }
+    cost = sum(weights[name] * value for name, value in terms.items())
+    return OrientationScore(index, cost, **terms)
+
+
+def score_orientation(points, weights=None, profile=DEFAULT_PROFILE, index=None):
+    """
+    Scores a calculated PointObject. One that was abandoned by find_bends (no bends) gets an infinite cost.
+    """
+    if len(points.A) == 0:
+        return OrientationScore(index, math.inf, points.collision_count, points.deleted_vertices, 0, 0.0, 0.0)
+    return score_program(points.collision_count, points.deleted_vertices, BenderGCode(points).generate_gcode(),
+                         weights, profile, index)
+
+
+def rank_orientations(point_objects, weights=None, profile=DEFAULT_PROFILE):
+    """
+    Returns the OrientationScore of every orientation, cheapest first (the lower index wins a tie).
+    """
+    scores = [score_orientation(points, weights, profile, idx) for idx, points in enumerate(point_objects)]
+    return sorted(scores, key=lambda score: (score.cost, score.index))
+
+
+# collision count at which an orientation can no longer beat best_cost, whatever its other terms are (they are never
+# negative), see ImportCoords.calculate_best_orientation
+def collision_limit(best_cost, weights=None):
+    weight = {**DEFAULT_WEIGHTS, **(weights or {})}["collisions"]
+    if best_cost is None or weight <= 0 or math.isinf(best_cost):
+        return None
+    return max(math.ceil(best_cost / weight), 0)
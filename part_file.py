@@ -0,0 +1,88 @@
+"""
+This module saves a part and everything calculated for it to a single compressed .npz file and reads it back.
+
+The file holds the raw coordinates and, for each of the four bend orientations, the converted points, the L R A MA
+tables, the collision, deleted and simplified vertex counts and the simplification deviation. It also holds a key, a
+hash of everything the results depend on (coordinates, wire diameter, pin position, material file contents, the
+machine envelope, the version of the pipeline code and any other settings). Reopening a part with the same inputs and
+the same code gives the same key, so the stored results can be used without recalculating anything.
+
+Anderson Boyer
+"""
+
+import hashlib
+import json
+import numpy as np
+from collision import MachineEnvelope
+from point_object import PointObject
+from result_cache import CODE_VERSION
+
+FORMAT_VERSION = 2
+
+
+def part_key(coords, diameter, pin_pos, material_path, envelope=None, **settings):
+    """
+    Returns a hex digest identifying a calculation: the raw coordinates, the machine setup, the contents of the
+    material file, the boxes of the machine envelope (None is MachineEnvelope.default()), result_cache.CODE_VERSION
+    and any extra keyword settings (for example swept_collisions) that change the result.
+    """
+    envelope = envelope if envelope is not None else MachineEnvelope.default()
+    digest = hashlib.sha256()
+    digest.update(f"wirebender part v{FORMAT_VERSION} code {CODE_VERSION}".encode())
+    digest.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    digest.update(json.dumps({"diameter": float(diameter), "pin_pos": float(pin_pos), **settings},
+                             sort_keys=True).encode())
+    digest.update(np.concatenate((envelope.lower, envelope.upper), axis=1).tobytes())
+    with open(material_path, 'rb') as file:
+        digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def save_part(path, key, coords, point_objects):
+    arrays = {
+        "version": np.array(FORMAT_VERSION),
+        "key": np.array(key),
+        "coords": np.asarray(coords, dtype=np.float64),
+        "orientations": np.array(len(point_objects)),
+    }
+    for idx, points in enumerate(point_objects):
+        prefix = f"o{idx}_"
+        arrays[prefix + "points"] = points.points
+        for name in ("L", "R", "A", "MA"):
+            arrays[prefix + name] = np.asarray(getattr(points, name), dtype=np.float64)
+        arrays[prefix + "counts"] = np.array([points.collision_count, points.deleted_vertices,
+                                              points.simplified_vertices])
+        arrays[prefix + "deviation"] = np.array(points.deviation, dtype=np.float64)
+        arrays[prefix + "pin_pos"] = np.array(points.pin_pos, dtype=np.float64)
+        arrays[prefix + "self_intersections"] = np.asarray(points.self_intersections, dtype=np.int64).reshape(-1, 2)
+
+    np.savez_compressed(path, **arrays)
+
+
+def load_part(path, key=None, envelope=None):
+    """
+    Reads a file written by save_part and returns (key, coords, point_objects).
+
+    point_objects is None if the file was written by another format version or if key is given and does not
+    match the stored one, the raw coordinates are returned either way. The per-point collision reports are not
+    stored, so collisions is empty on the restored point objects.
+    """
+    with np.load(path) as data:
+        stored_key = str(data["key"])
+        coords = data["coords"]
+        if int(data["version"]) != FORMAT_VERSION or (key is not None and key != stored_key):
+            return stored_key, coords, None
+
+        point_objects = []
+        for idx in range(int(data["orientations"])):
+            prefix = f"o{idx}_"
+            points = PointObject.from_array(data[prefix + "points"], envelope)
+            points.L, points.R, points.A, points.MA = (data[prefix + name].tolist() for name in ("L", "R", "A", "MA"))
+            points.collision_count, points.deleted_vertices, points.simplified_vertices = (
+                int(count) for count in data[prefix + "counts"])
+            points.deviation = float(data[prefix + "deviation"])
+            points.pin_pos = float(data[prefix + "pin_pos"])
+            points.self_intersections = data[prefix + "self_intersections"]
+            point_objects.append(points)
+
+    return stored_key, coords, point_objects
@@ -16,6 +16,12 @@ Anderson Boyer
 
 import math
 import numpy as np
+from collision import CollisionReport, MachineEnvelope, SegmentSphereIndex
+from instrumentation import INSTRUMENTS
+from material_registry import motor_angles
+from roll_sections import find_roll_sections
+
+PROGRESS_VERTICES = 200  # find_bends reports its progress every this many vertices
 
 class PointObject:
     """
@@ -24,25 +30,55 @@ class PointObject:
     A = Angle of Bend
     MA = Motor Angle for a particular bend, populated in apply_compensation()
     """
-    def __init__(self, x, y, z):
-        self.X, self.Y, self.Z = x, y, z
+    def __init__(self, x, y, z, envelope=None):
+        # coordinates live in a single (N, 3) array, X Y and Z are column views into it
+        self.points = np.column_stack((x, y, z)).astype(np.float64)
         self.L, self.R, self.A, self.MA = [], [], [], []
+        # machine volume the part is checked against while bending, see collision.py
+        self.envelope = envelope if envelope is not None else MachineEnvelope.default()
         self.collision_count = 0
+        self.collisions = []
+        # (n, 2) segment pairs of the finished part that touch each other, filled by swept_collision_detection
+        self.self_intersections = np.zeros((0, 2), dtype=int)
         self.deleted_vertices = 0
+        # vertices removed within max_deviation and the largest distance (mm) of an original point from the
+        # simplified polyline, see polyline_simplify.py
+        self.simplified_vertices = 0
+        self.deviation = 0.0
         self.pin_pos = 0.0
+        # constant curvature runs of the bend tables, written as loops by BenderGCode, see roll_sections.py
+        self.roll_sections = []
 
-    def translate_to_origin(self, index):
-        x0, y0, z0 = self.X[index], self.Y[index], self.Z[index]
+    @classmethod
+    def from_array(cls, points, envelope=None):
+        point_object = cls([], [], [], envelope)
+        point_object.points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        return point_object
+
+    @property
+    def X(self):
+        return self.points[:, 0]
+
+    @property
+    def Y(self):
+        return self.points[:, 1]
 
-        for i in range(len(self.X)):
-            self.X[i] -= x0
-            self.Y[i] -= y0
-            self.Z[i] -= z0
+    @property
+    def Z(self):
+        return self.points[:, 2]
+
+    def __len__(self):
+        return len(self.points)
+
+    # returns a view of a single point, writing to it changes the point object
+    def point(self, index):
+        return self.points[index]
+
+    def translate_to_origin(self, index):
+        self.points -= self.points[index].copy()
 
     def reverse_order_coord(self):
-        self.X = self.X[::-1]
-        self.Y = self.Y[::-1]
-        self.Z = self.Z[::-1]
+        self.points = np.ascontiguousarray(self.points[::-1])
 
     def reverse_order_bends(self):
         self.L = self.L[::-1]
@@ -50,22 +86,26 @@ class PointObject:
         self.A = self.A[::-1]
 
     def find_rz2(self, index):
-        return math.atan2(self.X[index], self.Y[index])  # reference angle from Y
+        x, y, _ = self.points[index]
+        return math.atan2(x, y)  # reference angle from Y
 
     def find_rx2(self, index):
-        return -1 * math.atan2(self.Z[index], self.Y[index])  # reference angle from Y
+        _, y, z = self.points[index]
+        return -1 * math.atan2(z, y)  # reference angle from Y
 
     def find_ry2(self, index):
-        if index < len(self.Z):
-            return math.atan2(self.Z[index], self.X[index])  # reference angle from X
+        if index < len(self.points):
+            x, _, z = self.points[index]
+            return math.atan2(z, x)  # reference angle from X
         else:
             print("Array size too small for conversion after minimum bend checking")
             return 0
 
     def find_ry(self, index):
-        if self.X[index] == 0.0:
+        x, _, z = self.points[index]
+        if x == 0.0:
             return math.pi/2
-        return math.atan(self.Z[index] / self.X[index])  # reference angle from X
+        return math.atan(z / x)  # reference angle from X
 
     @staticmethod
     def rotation_matrix(radians, axis):
@@ -85,31 +125,121 @@ class PointObject:
         return matrix
 
     def rotate(self, matrix):
-
-        # Create 3x1 column vectors for x, y, z arrays
-        vectors = np.vstack((self.X, self.Y, self.Z))
-        # Perform matrix multiplication
-        rotated_vectors = np.dot(matrix, vectors)
-        # Update x, y, z arrays with the rotated vectors
-        self.X, self.Y, self.Z = rotated_vectors
+        INSTRUMENTS.count("polyline_rotations")
+        # rotate every point in place, points are rows so this is P @ M^T
+        self.points[:] = self.points @ matrix.T
 
     def calculate_distance(self, index1, index2):
-        if index1 < 0 or index1 >= len(self.X) or index2 < 0 or index2 >= len(self.X):
+        if index1 < 0 or index1 >= len(self.points) or index2 < 0 or index2 >= len(self.points):
             return None
 
         # Calculate Euclidean distance between points at index1 and index2
-        distance = math.sqrt((self.X[index2] - self.X[index1]) ** 2 +
-                             (self.Y[index2] - self.Y[index1]) ** 2 +
-                             (self.Z[index2] - self.Z[index1]) ** 2)
-        return distance
+        return math.dist(self.points[index1], self.points[index2])
+
+    @INSTRUMENTS.timed("find_bends")
+    def find_bends(self, diameter, max_collisions=None, swept=False, progress=None):
+        """
+        Calculates L, R and A for every bend by carrying a local frame from vertex to vertex.
+
+        The frame is the same one find_bends_rotating produces by translating and rotating the whole polyline:
+        the current vertex is the origin and the incoming segment lies on +Y. Here only the next point is
+        expressed in that frame and the frame itself is rotated, so each vertex costs O(1) and the points are
+        never modified.
+
+        If max_collisions is given the calculation is abandoned as soon as collision_count reaches it. L, R and A
+        are cleared in that case and False is returned, otherwise True.
+
+        With swept=True the point checks are replaced by swept_collision_detection, which tests the wire segments
+        as capsules after all frames are known.
+
+        progress(vertex, vertices) is called every PROGRESS_VERTICES vertices, it may raise to stop the calculation.
+        """
+        bend_die_radius = 2.5
+        points = self.points
+        n = len(points)
+        # rigid transforms do not change segment lengths, so they can all be taken from the original points
+        lengths = np.linalg.norm(np.diff(points, axis=0), axis=1).tolist()
+
+        # local = frame @ (point - origin)
+        origin = np.zeros(3)
+        frame = np.eye(3)
+
+        self.L.append(0)
+        self.A.append(0)
+
+        # (vertex, start index, origin index, origin, frame) of every check, for the swept checks at the end
+        swept_checks = []
+
+        def check(start_index, origin_index):
+            if swept:
+                swept_checks.append((i, start_index, origin_index, origin, frame))
+            else:
+                self.collision_detection(start_index, origin, frame, i)
+
+        for i in range(1, n - 1):
+            if max_collisions is not None and self.collision_count >= max_collisions:
+                INSTRUMENTS.count("frame_rotations", 2 * (i - 1))
+                INSTRUMENTS.count("abandoned_orientations")
+                self.L, self.R, self.A = [], [], []
+                return False
+            if progress is not None and i % PROGRESS_VERTICES == 0:
+                progress(i, n)
+
+            check(i, i - 1)
+
+            origin = points[i]
 
-    def find_bends(self, diameter):
+            check(i + 1, i)
 
-        x_copy, y_copy, z_copy = self.X.copy(), self.Y.copy(), self.Z.copy()
+            x, y, z = (frame @ (points[i + 1] - origin)).tolist()
+            ry = math.pi / 2 if x == 0.0 else math.atan(z / x)  # same as find_ry
+            self.R.append(math.degrees(ry))
+            frame = self.rotation_matrix(ry, 'y') @ frame
+            x = math.cos(ry) * x + math.sin(ry) * z
+
+            check(i + 1, i)
+
+            if i < n - 2:  # only add L if this is not the last bend
+                self.L.append(lengths[i])
+
+            rz = math.atan2(x, y)  # same as find_rz2
+            self.A.append(math.degrees(rz))
+            frame = self.rotation_matrix(rz, 'z') @ frame
+
+            check(i + 1, i)
+
+        # the frame is rotated about Y and Z at every bend
+        INSTRUMENTS.count("frame_rotations", 2 * max(n - 2, 0))
+
+        if swept and not self.swept_collision_detection(diameter, swept_checks, max_collisions):
+            self.L, self.R, self.A = [], [], []
+            return False
+
+        # for the last point, extrusion length will be equal to L + 1/2 the arc length of next bend -
+        # 2.5mm (bend die radius)
+        arc_length = .5 * abs(math.radians(self.A[-1])) * (bend_die_radius + diameter / 2)
+        self.L.append(lengths[-1] + arc_length - bend_die_radius)
+        self.R.append(0)
+
+        if len(self.A) > 1:
+            # for the first point, extrusion length will be equal to L - 1/2 the arc length of next
+            # bend + 2.5mm (bend die radius)
+            arc_length = .5 * abs(math.radians(self.A[1])) * (bend_die_radius + diameter / 2)
+            # bend die radius subtracted here because we assume the user cuts the part off flush with the bend die
+            self.L[0] = lengths[0] - arc_length + bend_die_radius
+
+        self.reverse_order_bends()
+        return True
+
+    # original bend solver, rotates the whole polyline twice at every vertex which makes it O(N^2)
+    # kept as the reference that find_bends is checked against
+    def find_bends_rotating(self, diameter):
+
+        points_copy = self.points.copy()
         bend_die_radius = 2.5
 
-        for i in range(len(self.X)):
-            if i >= len(self.X) - 1:  # last point
+        for i in range(len(self.points)):
+            if i >= len(self.points) - 1:  # last point
                 # for the first point, extrusion length will be equal to L + 1/2 the arc length of next bend -
                 # 2.5mm (bend die radius)
                 arc_length = .5 * abs(math.radians(self.A[-1])) * (bend_die_radius + diameter / 2)  # 1/2 arc length
@@ -118,7 +248,7 @@ class PointObject:
                 # for the first point, extrusion length will be equal to L + 1/2 the arc length of next bend + 2.5mm
                 # (bend die radius)
                 self.R.append(0)
-                self.X, self.Y, self.Z = x_copy, y_copy, z_copy
+                self.points = points_copy
             elif i <= 0:  # first point
                 self.L.append(0)
                 self.A.append(0)
@@ -140,7 +270,7 @@ class PointObject:
                 # of prev bend in mm
                 arc_length_next = .5 * abs(math.radians(self.A[-1])) * (bend_die_radius + diameter / 2)  # 1/2 arc
                 # length of next bend in mm
-                if i < len(self.X) - 2:  # only add L if this is not the last bend
+                if i < len(self.points) - 2:  # only add L if this is not the last bend
                     self.L.append(self.calculate_distance(i, i + 1)) #- arc_length_prev + arc_length_next)
 
                 self.A.append(math.degrees(self.find_rz2(i + 1)))
@@ -159,46 +289,126 @@ class PointObject:
 
         self.reverse_order_bends()
 
-    def collision_detection(self, start_index):
-        # collision area in mm
-        # coordinate system same as machine
-        limits = {
-            'x': [-150, 150],
-            'y': [-1000, -5],
-            'z': [-100, -5]
-        }
-        # Check if any point past the start_index lies inside the cube
-        for i in range(start_index, len(self.X)):
-            point = [self.X[i], self.Y[i], self.Z[i]]
-            if self.point_inside_cube(point, limits):
-                self.collision_count += 1
-                return True  # Collision detected
+    def collision_detection(self, start_index, origin=None, frame=None, vertex=None):
+        """
+        Counts a collision if any point from start_index on lies inside the machine envelope.
+
+        Without a frame the points are checked as they are. With a frame they are first moved into the
+        local coordinate system, local = frame @ (point - origin), which is what find_bends uses.
+        Every counted collision is kept in self.collisions as a CollisionReport for the bend vertex
+        (start_index if vertex is not given) with the points that hit and where they are in that frame.
+        """
+        INSTRUMENTS.count("collision_checks")
+        points = self.points[start_index:]
+        if frame is not None:
+            points = (points - origin) @ frame.T
+
+        report = self.envelope.check(points, start_index, start_index if vertex is None else vertex)
+        if report is not None:
+            self.collision_count += 1
+            INSTRUMENTS.count("collisions")
+            self.collisions.append(report)
+            return True  # Collision detected
         return False  # No collision
 
-    @staticmethod
-    def point_inside_cube(point, limits):
+    def swept_collision_detection(self, diameter, checks, max_collisions=None):
         """
-        Check if a point lies inside a cube defined by its x y and z limits
+        Capsule version of collision_detection for the checks find_bends(swept=True) collected.
+
+        Every wire segment from the check's start index on is treated as a capsule of the wire diameter, so a
+        segment that passes through the machine between two vertices is caught as well. Besides the envelope
+        boxes every check also includes the unbent wire (the part before the bend die, lying on -Y) so the
+        formed part hitting its own stock counts as a collision. Counting works like collision_detection,
+        one per check that hits anything, and the reports use segment indices (segment j runs from point j to
+        j + 1) with box index len(envelope.boxes) for the stock.
+
+        The part is also checked against itself while it is formed. The bent part in front of the die is rigid, so
+        two segments j < k that touch (closer than the wire diameter and more than pi diameters apart along the
+        wire) first touch when the bend at vertex j + 1 joins segment j to it, and stay in contact from then on.
+        Every such bend counts one collision, reported with the segments k and box index len(envelope.boxes) + 1.
+        self.self_intersections holds all touching pairs. Like the point checks, the part is checked at the
+        positions before and after each rotation and bend, not along the way between them.
+        Returns False if max_collisions was reached.
         """
-        x, y, z = point
-        x_min, x_max = limits['x']
-        y_min, y_max = limits['y']
-        z_min, z_max = limits['z']
-
-        if (x_min < x < x_max) & (y_min < y < y_max) & (z_min < z < z_max):
-            return True  # Point lies inside the cube
-        return False  # Point does not lie inside the cube
+        bend_die_radius = 2.5
+        radius = diameter / 2
+        INSTRUMENTS.count("collision_checks", len(checks))
+        index = SegmentSphereIndex(self.points)
+        if len(checks) == 0:
+            self.self_intersections = index.self_intersections(radius)
+            return True
+
+        vertices, start_indices, origin_indices, origins, frames = (np.array(column) for column in zip(*checks))
+        box_count = len(self.envelope.boxes) + 1
+
+        # self contact during forming, counted at the bend that makes it
+        self.self_intersections = index.self_intersections(radius)
+        if len(self.self_intersections):
+            # position in the frame after the bend, that is the last check of the vertex
+            last_check = {int(vertex): check for check, vertex in enumerate(vertices)}
+            firsts = self.self_intersections[:, 0]
+            for group in np.split(self.self_intersections, np.flatnonzero(np.diff(firsts)) + 1):
+                vertex = int(group[0, 0]) + 1
+                segments = np.unique(group[:, 1])
+                check = last_check.get(vertex)
+                position = (self.points[segments] if check is None
+                            else (self.points[segments] - origins[check]) @ frames[check].T)
+                self.collisions.append(CollisionReport(vertex, segments, np.full(len(segments), box_count),
+                                                       position))
+                self.collision_count += 1
+                INSTRUMENTS.count("collisions")
+            if max_collisions is not None and self.collision_count >= max_collisions:
+                return False
+
+        # a check starting at point k tests segment k - 1 (ending at k) onwards
+        first_segments = np.maximum(start_indices - 1, 0)
+
+        # unbent wire on -Y, the bend die area itself is left out
+        clearance = bend_die_radius + diameter
+        stock_length = np.maximum(index.wire_length[origin_indices], clearance + diameter)
+        stock_lower = np.column_stack((np.full(len(checks), -radius), -stock_length, np.full(len(checks), -radius)))
+        stock_upper = np.tile([radius, -clearance, radius], (len(checks), 1))
+
+        lower = np.concatenate((np.broadcast_to(self.envelope.lower, (len(checks), box_count - 1, 3)),
+                                stock_lower[:, None]), axis=1)
+        upper = np.concatenate((np.broadcast_to(self.envelope.upper, (len(checks), box_count - 1, 3)),
+                                stock_upper[:, None]), axis=1)
+
+        # the last check of a vertex and the first one of the next are the same, they are only tested once
+        new = np.ones(len(checks), dtype=bool)
+        new[1:] = ((start_indices[1:] != start_indices[:-1]) | (origin_indices[1:] != origin_indices[:-1])
+                   | np.any(frames[1:] != frames[:-1], axis=(1, 2)))
+        unique = np.flatnonzero(new)
+        ends = np.append(unique[1:], len(checks))
+
+        # checks are processed in chunks so the (check, node, box) arrays stay small
+        chunk_size = 4096
+        for chunk in range(0, len(unique), chunk_size):
+            rows = unique[chunk:chunk + chunk_size]
+            _, reports = index.box_hits(origins[rows], frames[rows], first_segments[rows], lower[rows], upper[rows],
+                                        radius)
+            for row, segments, boxes in reports:
+                first = rows[row]
+                position = (self.points[segments] - origins[first]) @ frames[first].T
+                for check in range(first, ends[chunk + row]):
+                    self.collisions.append(CollisionReport(int(vertices[check]), segments, boxes, position))
+                    self.collision_count += 1
+                    INSTRUMENTS.count("collisions")
+
+            if max_collisions is not None and self.collision_count >= max_collisions:
+                return False
+        return True
 
     def get_lra_data(self):
         # Assuming you have arrays named L, R, and A
         return [(round(length, 3), round(rotation, 3), round(angle, 3), round(motor_angle, 3)) for length,
                 rotation, angle, motor_angle in zip(self.L, self.R, self.A, self.MA)]
 
+    @INSTRUMENTS.timed("apply_compensation")
     def apply_compensation(self, compensation_coeff):
-        for i in range(len(self.A)):
-            if self.A[i] < -.05:
-                self.MA.append(-1 * np.polyval(compensation_coeff, abs(self.A[i])))
-            elif self.A[i] > .05:
-                self.MA.append(np.polyval(compensation_coeff, abs(self.A[i])))
-            else:
-                self.MA.append(0.0)
+        self.MA.extend(motor_angles(compensation_coeff, self.A).tolist())
+
+    # needs the compensated bend tables, clearance shortens the pin return inside a section
+    def find_roll_sections(self, clearance=None):
+        self.roll_sections = find_roll_sections(self.L, self.R, self.A, self.MA, clearance)
+        return self.roll_sections
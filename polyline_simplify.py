@@ -0,0 +1,135 @@
+"""
+This module turns the coordinates of a part into a polyline the bender can make.
+
+simplify_polyline makes two passes over the points:
+- with max_deviation, vertices that can go without moving the polyline more than max_deviation mm away from any of
+  the original points are removed first (Douglas-Peucker). A dense CAD spline keeps its vertices where it bends
+  sharply and loses them where it is nearly straight. This is O(N log N) for normal curves.
+- every segment has to be long enough for the bend at its end (the minimum bend distance of the bend angle, see
+  min_bend_dist.py). Walking from the start, the end vertex of a segment that is too short is removed and the
+  segment is tried again up to the next vertex, the last segment is extended instead of shortened. This is the
+  minimum extrusion loop that used to delete from the point array in ImportCoords.convert_orientation. The kept
+  vertices are collected in a list instead, so a removal costs O(1) and the pass is linear.
+
+A segment that is too short cannot be bent at all, so the minimum bend distance wins over max_deviation. The
+deviation of the result from the original points is always reported, a part that moved too far can be rejected.
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import math
+import numpy as np
+
+BEND_DIE_RADIUS = 2.5
+
+SimplifyReport = namedtuple("SimplifyReport", ["simplified_vertices", "deleted_vertices", "deviation"])
+
+
+# angle between the segments prev_point -> point and point -> next_point in radians, plain floats are faster than
+# numpy for single 3-vectors
+def bend_angle(prev_point, point, next_point):
+    (x0, y0, z0), (x1, y1, z1), (x2, y2, z2) = prev_point, point, next_point
+    sx, sy, sz = x1 - x0, y1 - y0, z1 - z0
+    nx, ny, nz = x2 - x1, y2 - y1, z2 - z1
+
+    cx = sy * nz - sz * ny
+    cy = sz * nx - sx * nz
+    cz = sx * ny - sy * nx
+    return math.atan2(math.sqrt(cx ** 2 + cy ** 2 + cz ** 2), sx * nx + sy * ny + sz * nz)
+
+
+def segment_distances(points, starts, ends):
+    """
+    Distance of every point to the segment from the matching row of starts to the one of ends, all (N, 3) arrays.
+    """
+    direction = ends - starts
+    length_sq = np.einsum('ij,ij->i', direction, direction)
+    t = np.einsum('ij,ij->i', points - starts, direction) / np.where(length_sq > 0, length_sq, 1.0)
+    closest = starts + np.clip(t, 0.0, 1.0)[:, None] * direction
+    return np.linalg.norm(points - closest, axis=1)
+
+
+def douglas_peucker(points, max_deviation):
+    """
+    Returns the sorted indices of the points to keep so no point is more than max_deviation from the polyline through
+    the kept ones. The first and last point are always kept.
+    """
+    count = len(points)
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = points[first + 1:last]
+        distances = segment_distances(inner, np.broadcast_to(points[first], inner.shape),
+                                      np.broadcast_to(points[last], inner.shape))
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > max_deviation:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+# indices of the vertices that leave every segment long enough for the bend at its end, and how far the last point
+# has to be moved along the last segment (0 if that segment is long enough)
+def _min_bend_walk(points, diameter, min_bend_dist):
+    pts = points.tolist()
+    count = len(pts)
+    if count < 3:
+        return list(range(count)), 0.0
+
+    half_arc = .5 * (BEND_DIE_RADIUS + diameter / 2)  # 1/2 arc length of a bend per radian
+    kept = [0, 1]
+    extension = 0.0
+    for j in range(2, count):
+        # kept[-1] is the current vertex and j the next one, the ones between were removed
+        if j < count - 1:
+            angle1 = bend_angle(pts[kept[-2]], pts[kept[-1]], pts[j])
+            angle2 = bend_angle(pts[kept[-1]], pts[j], pts[j + 1])
+            distance = math.dist(pts[kept[-1]], pts[j]) - half_arc * abs(angle2) + half_arc * abs(angle1)
+            if distance < min_bend_dist(angle2):
+                continue
+        else:
+            angle2 = bend_angle(pts[kept[-2]], pts[kept[-1]], pts[j])
+            distance = math.dist(pts[kept[-1]], pts[j]) + half_arc * abs(angle2) - BEND_DIE_RADIUS
+            if distance < min_bend_dist(angle2):
+                extension = distance
+        kept.append(j)
+    return kept, extension
+
+
+def simplify_polyline(points, diameter, min_bend_dist, max_deviation=None):
+    """
+    Simplifies an (N, 3) array of points, see the module docstring. min_bend_dist is called with a bend angle in
+    radians and returns the shortest segment in mm that bend can follow (get_min_bend_table). max_deviation is in mm,
+    None skips the first pass.
+
+    Returns the new (M, 3) array and a SimplifyReport with the vertices removed by each pass and the largest
+    distance in mm of an original point from the new polyline.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    indices = np.arange(len(points))
+    if max_deviation is not None and len(points) > 2:
+        indices = douglas_peucker(points, max_deviation)
+
+    kept, extension = _min_bend_walk(points[indices], diameter, min_bend_dist)
+    kept = indices[kept]
+    result = points[kept]
+    if extension and len(result) >= 2:
+        direction_vector = result[-1] - result[-2]
+        direction_vector /= np.linalg.norm(direction_vector)
+        result[-1] += extension * direction_vector
+
+    deviation = 0.0
+    if len(result) >= 2:
+        # every original point is compared with the new segment that spans it
+        segment = np.clip(np.searchsorted(kept, np.arange(len(points)), side='right') - 1, 0, len(kept) - 2)
+        deviation = float(segment_distances(points, result[segment], result[segment + 1]).max())
+
+    report = SimplifyReport(len(points) - len(indices), len(indices) - len(kept), deviation)
+    return result, report
@@ -0,0 +1,153 @@
+"""
+This module is an on-disk cache for the results of the whole CAM pipeline, so a part that was already run with the
+same material and machine setup does not go through the bend solve again.
+
+Entries are content addressed: the key is a hash of the raw coordinates, the material file contents, the diameter,
+the pin position, any other settings and CODE_VERSION (a hash of the pipeline source files, so a code change never
+returns stale results). Each entry holds, for every orientation, the L R A MA tables, the collision and deleted
+vertex counts and the generate_gcode output.
+
+Several batch workers can share one cache directory. Entries are written to a temporary file and renamed into
+place, so a reader sees either the whole entry or none. The size of the directory is bounded: when it grows past
+max_bytes the least recently used entries (by file modification time, which is refreshed on every hit) are removed.
+
+Anderson Boyer
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+ENTRY_SUFFIX = ".json"
+
+# modules whose code decides the cached results
+PIPELINE_SOURCES = ("bender_gcode.py", "collision.py", "compensation_models.py", "import_coords.py",
+                    "material_registry.py", "min_bend_dist.py", "point_object.py", "polyline_simplify.py",
+                    "roll_sections.py")
+
+
+def _code_version():
+    digest = hashlib.sha256()
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in PIPELINE_SOURCES:
+        with open(os.path.join(source_dir, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+CODE_VERSION = _code_version()
+
+
+class ResultCache:
+    """
+    Size bounded LRU cache of pipeline results in a directory.
+
+    get and put never raise on cache problems (a damaged or vanished entry is a miss, a failed write is ignored),
+    the cache can only make a run faster. hits, misses and evictions count the calls made through this instance.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """
+        Returns the stored entry for key (see put) or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                entry = json.load(file)
+            # mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def put(self, key, orientations):
+        """
+        Stores the results of one run. orientations is a list with one dict per orientation holding L, R, A, MA,
+        collision_count, deleted_vertices, deviation and gcode (the [gcode, comment] lists from generate_gcode).
+        """
+        entry = {"key": key, "code_version": CODE_VERSION, "orientations": orientations}
+        try:
+            handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, 'w') as file:
+                json.dump(entry, file)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache is at most max_bytes, returns the number removed.
+        Other workers may be removing entries at the same time, entries that are already gone are skipped.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for item in scan:
+                if not item.name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+
+        self.evictions += removed
+        return removed
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0}
+
+
+# converts the calculated point objects of a run to the list stored by ResultCache.put
+def cache_orientations(point_objects, gcode_strings):
+    return [{"L": [float(value) for value in points.L], "R": [float(value) for value in points.R],
+             "A": [float(value) for value in points.A], "MA": [float(value) for value in points.MA],
+             "collision_count": points.collision_count, "deleted_vertices": points.deleted_vertices,
+             "deviation": points.deviation,
+             "gcode": gcode_string}
+            for points, gcode_string in zip(point_objects, gcode_strings)]
+
+
+# puts the tables and counts of cached orientations back on the point objects, the reverse of cache_orientations
+def restore_orientations(point_objects, orientations):
+    for points, orientation in zip(point_objects, orientations):
+        points.L, points.R, points.A, points.MA = (orientation[name] for name in ("L", "R", "A", "MA"))
+        points.collision_count = orientation["collision_count"]
+        points.deleted_vertices = orientation["deleted_vertices"]
+        points.deviation = orientation["deviation"]
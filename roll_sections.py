@@ -0,0 +1,128 @@
+"""
+This module finds the constant curvature runs of a part and writes them as compact roll sections in the G-Code.
+
+A smooth curve in the coordinate file becomes a long run of small bends that are all the same: the same feed between
+them, the same wire rotation (0 for a flat arc, constant for a helix) and the same bend angle. find_roll_sections
+finds those runs in the L R A tables of a PointObject and describes each one as a single RollSection (start, number
+of bends, spacing, rotation, angle and the radius of the arc). BenderGCode writes a RollSection as one RepRapFirmware
+while loop instead of one block of lines per bend:
+
+    while iterations < 40             ;  Roll section: 40 bends of 4.5 degrees, 2.0 mm apart, radius 25.5 mm
+      G0 X{52.5 + 2.0 * iterations}   ;  Extrude wire 2.0 mm
+      G1 Z17.2                        ;  Setting motor angle to 17.2 degrees for 4.5 degree desired bend
+      G0 Z-30                         ;  Return pin to negative position
+
+Between the bends of a section the pin only needs to get off the wire, not all the way back to its start side.
+With a clearance (degrees) the pin returns that far from the bend's motor angle instead of to Z+-30, which is where
+the machine time is saved. It depends on the pin and the wire, so it is off unless a clearance is given.
+
+iter_expanded and expand_loops turn the loops back into one line per bend for everything that reads the program
+line by line (the cycle time simulation, the optimizer and the network sender).
+
+Anderson Boyer
+"""
+
+from collections import namedtuple
+import math
+import re
+
+MIN_ROLL_BENDS = 4  # shorter runs are written bend by bend
+LENGTH_TOLERANCE = .02  # mm
+ANGLE_TOLERANCE = .1  # degrees, for both the bend angle and the wire rotation
+PIN_RETURN = 30  # degrees, where generate_gcode returns the pin to after a bend
+
+RollSection = namedtuple("RollSection", ["start", "count", "length", "rotation", "angle", "motor_angle",
+                                         "return_angle", "radius", "angle_error"])
+
+_LOOP_VALUE = re.compile(r"\{(-?[\d.]+) ([+-]) ([\d.]+) \* iterations\}")
+
+
+# the bend at step j can be made with the values of the bend at step start
+def _matches(L, R, A, j, start, length_tolerance, angle_tolerance):
+    return (abs(A[j]) > .02 and abs(L[j]) > .01 and (A[j] > 0) == (A[start] > 0)
+            and abs(L[j] - L[start]) <= length_tolerance
+            and abs(A[j] - A[start]) <= angle_tolerance
+            and abs(R[j] - R[start]) <= angle_tolerance)
+
+
+def find_roll_sections(L, R, A, MA, clearance=None, min_bends=MIN_ROLL_BENDS, length_tolerance=LENGTH_TOLERANCE,
+                       angle_tolerance=ANGLE_TOLERANCE):
+    """
+    Returns the RollSections of the bend tables (in G-Code order, as find_bends leaves them). A section is a run of
+    at least min_bends steps whose feed, rotation and bend angle stay within the tolerances of its first step.
+    Every value of a section is the mean over its steps, angle_error is the largest difference of a bend from it.
+    clearance (degrees) shortens the pin return between the bends, see the module docstring.
+    """
+    sections = []
+    start = 0
+    while start < len(A):
+        end = start
+        while end < len(A) and _matches(L, R, A, end, start, length_tolerance, angle_tolerance):
+            end += 1
+        if end - start < min_bends:
+            start = max(end, start + 1)
+            continue
+
+        count = end - start
+        length = sum(L[start:end]) / count
+        angle = sum(A[start:end]) / count
+        motor_angle = sum(MA[start:end]) / count
+        return_angle = None
+        if clearance is not None:
+            # never further than the normal return
+            return_angle = (max(motor_angle - clearance, -PIN_RETURN) if angle > 0
+                            else min(motor_angle + clearance, PIN_RETURN))
+        radius = length / (2 * math.sin(math.radians(abs(angle)) / 2))
+        sections.append(RollSection(start, count, length, sum(R[start:end]) / count, angle, motor_angle,
+                                    return_angle, radius, max(abs(a - angle) for a in A[start:end])))
+        start = end
+    return sections
+
+
+# position of a loop axis: start on the first iteration, then step more on every iteration
+def loop_value(start, step):
+    sign = "-" if step < 0 else "+"
+    # fixed point, a small step would otherwise be written as 5e-05, which neither the firmware nor _unroll reads
+    return f"{{{start:.4f} {sign} {abs(step):.4f} * iterations}}"
+
+
+# value of a loop_value expression on one iteration, fixed point like loop_value writes it
+def _loop_position(match, iteration):
+    return f"{float(match[1]) + (1 if match[2] == '+' else -1) * float(match[3]) * iteration:.4f}"
+
+
+def _unroll(header, body):
+    count = int(header[0].split(';', 1)[0].split()[-1])
+    for iteration in range(count):
+        for line, line_comment in body:
+            yield _LOOP_VALUE.sub(lambda match: _loop_position(match, iteration), line.strip()), line_comment
+
+
+def iter_expanded(lines):
+    """
+    Unrolls the roll section loops of (gcode, comment) pairs one pair at a time: the body of every while loop is
+    repeated with the loop positions worked out. Only the body of the current loop is held in memory.
+    """
+    header, body = None, []
+    for line, line_comment in lines:
+        if header is not None:
+            if line.startswith("  "):
+                body.append((line, line_comment))
+                continue
+            yield from _unroll(header, body)
+            header, body = None, []
+        if line.startswith("while iterations < "):
+            header = (line, line_comment)
+        else:
+            yield line, line_comment
+    if header is not None:
+        yield from _unroll(header, body)
+
+
+def expand_loops(gcode, comment=None):
+    """
+    List version of iter_expanded, takes the G-Code lines and optionally the matching comments and returns the same.
+    """
+    comment = comment if comment is not None else [""] * len(gcode)
+    pairs = list(iter_expanded(zip(gcode, comment)))
+    return [line for line, _ in pairs], [line_comment for _, line_comment in pairs]
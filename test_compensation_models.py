@@ -0,0 +1,44 @@
+"""
+Checks of the compensation models against the material files that ship with the program.
+
+    python -m unittest test_compensation_models
+
+Anderson Boyer
+"""
+
+import os
+import unittest
+import numpy as np
+from compensation_models import MIN_COMPENSATED_ANGLE, CompensationModel
+from material_registry import MATERIALS_DIR, read_material
+
+# bends up to MIN_COMPENSATED_ANGLE are not made, past that the motor angle has to grow with the bend
+ANGLES = np.linspace(2 * MIN_COMPENSATED_ANGLE, 180, 3600)
+
+
+def material_files():
+    return sorted(name for name in os.listdir(MATERIALS_DIR) if name.lower().endswith(".csv"))
+
+
+class CompensationModelTest(unittest.TestCase):
+    def test_pchip_and_spline_are_monotone_for_every_material(self):
+        for name in material_files():
+            compensation_data = read_material(os.path.join(MATERIALS_DIR, name))
+            for kind in ("pchip", "spline"):
+                with self.subTest(material=name, kind=kind):
+                    model = CompensationModel.fit(compensation_data, kind)
+                    self.assertTrue(np.all(np.diff(model(ANGLES)) >= 0))
+                    self.assertTrue(np.all(np.diff(model(-ANGLES)) <= 0))
+
+    def test_scalar_angle(self):
+        compensation_data = read_material(os.path.join(MATERIALS_DIR, material_files()[0]))
+        for kind in ("pchip", "spline"):
+            with self.subTest(kind=kind):
+                model = CompensationModel.fit(compensation_data, kind)
+                self.assertEqual(np.shape(model(45.0)), ())
+                self.assertAlmostEqual(float(model(45.0)), float(model(np.array([45.0]))[0]))
+                self.assertAlmostEqual(float(model(200.0)), float(model(np.array([200.0]))[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
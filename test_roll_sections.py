@@ -0,0 +1,27 @@
+"""
+Checks of the roll section loops: writing a loop position and unrolling it again.
+
+    python -m unittest test_roll_sections
+
+Anderson Boyer
+"""
+
+import unittest
+from roll_sections import iter_expanded, loop_value
+
+
+class LoopValueTest(unittest.TestCase):
+    def test_tiny_step_round_trip(self):
+        value = loop_value(0.5, 0.00006)
+        self.assertNotIn("e-", value)
+        lines = [("while iterations < 3", ""), (f"  G0 X{loop_value(1, 2)} Y{value}", ""), ("G28", "")]
+        self.assertEqual([line for line, _ in iter_expanded(lines)],
+                         ["G0 X1.0000 Y0.5000", "G0 X3.0000 Y0.5001", "G0 X5.0000 Y0.5002", "G28"])
+
+    def test_negative_step(self):
+        lines = [("while iterations < 2", ""), (f"  G0 Y{loop_value(-1, -0.00007)}", "")]
+        self.assertEqual([line for line, _ in iter_expanded(lines)], ["G0 Y-1.0000", "G0 Y-1.0001"])
+
+
+if __name__ == "__main__":
+    unittest.main()